@@ -18,14 +18,17 @@ frequencies = np.unique(
     np.round(np.logspace(np.log10(20), np.log10(20e3), 500)))
 print(f'frequencies = {frequencies}')
 
-# time axis
-t = np.arange(0, T, 1/fs)
-
 # multitone signal generation
-x = 0
-for f0 in frequencies:
-    random_phase = 2*np.pi*np.random.rand()
-    x += np.sin(2*np.pi*f0*t + random_phase)
+# one period (1 second) is created in the frequency domain: each frequency
+# gets an amplitude and a random phase in its FFT bin, then a single inverse
+# FFT gives the sum of all the sines (much faster than summing np.sin)
+random_phase = 2*np.pi*np.random.rand(len(frequencies))
+X_period = np.zeros(fs//2 + 1, dtype=complex)
+X_period[frequencies.astype('int')] = fs/2*np.exp(1j*(random_phase - np.pi/2))
+x_period = np.fft.irfft(X_period, fs)
+
+# the period is repeated to get T seconds
+x = np.tile(x_period, T)
 
 # signal normalization
 x /= np.max(np.abs(x))
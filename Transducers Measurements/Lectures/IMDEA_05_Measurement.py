@@ -2,6 +2,8 @@ import numpy as np
 import sounddevice as sd
 import matplotlib.pyplot as plt
 from functions.SynchSweptSine import SynchSweptSine
+from functions.play_record import play_record
+from functions.latency import estimate_latency
 
 ''' sample rate '''
 fs = 48000  # [Hz]
@@ -14,34 +16,31 @@ velocity_sensitivuty = 25e-3  # m/s / V
 
 ''' Devices (Sounddevice) '''
 print(sd.query_devices())
-sd.default.device = (6, 6)
+device = (6, 6)
 
 ''' Synchronized Swept-Sine signal '''
 sss = SynchSweptSine(f1=5, f2=22e3, fs=fs, T=5, fade=[int(fs), int(fs/10)])
-x = np.concatenate((sss.signal(), np.zeros(15000)))
+x = np.concatenate((sss.signal, np.zeros(15000)))
 
 ''' Playing and Recording '''
-y = sound_card_sensitivity * sd.playrec(0.8*x,  # input signal
-                                        samplerate=fs,
-                                        channels=3,
-                                        input_mapping=(8, 7, 6),
-                                        output_mapping=(9),
-                                        blocking=True)
+# calibrated (channels x samples) array: voltage [V], current [A], velocity [m/s]
+y = play_record(0.8*x, fs,
+                inputs=[8, 7, 6],
+                outputs=[9],
+                calibration={'inputs': sound_card_sensitivity*np.array(
+                    [voltage_sensitivuty, current_sensitivuty, velocity_sensitivuty])},
+                backend='sounddevice',
+                device=device)
 
-# extract the signals
-latency = 9400
-u = voltage_sensitivuty * y[latency:, 0]  # voltage [V]
-i = current_sensitivuty * y[latency:, 1]  # current [A]
-v = velocity_sensitivuty * y[latency:, 2]  # velocity [m/s]
+# extract the signals, the latency is estimated on the voltage (reference) channel
+# and removed here (it is not cached, the processing must not compensate it again)
+latency = estimate_latency(0.8*x, y[0])
+u, i, v = y[:, int(round(latency)):]
 
 ''' Synchronized Swept-Sine signal, FRF extraction'''
-u_ir = sss.getIR(u)
-i_ir = sss.getIR(i)
-v_ir = sss.getIR(v)
+u_ir, i_ir, v_ir = sss.getIR(np.array([u, i, v]))  # all channels at once
 
-U = np.fft.rfft(u_ir[:fs])
-I = np.fft.rfft(i_ir[:fs])
-V = np.fft.rfft(v_ir[:fs])
+U, I, V = np.fft.rfft(np.array([u_ir, i_ir, v_ir])[:, :fs], axis=-1)
 f_axis = np.fft.rfftfreq(fs, 1/fs)
 
 
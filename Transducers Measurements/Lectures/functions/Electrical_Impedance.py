@@ -1,3 +1,5 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 from scipy.optimize import least_squares
 
@@ -9,6 +11,11 @@ class Electrical_Impedance:
     Estimated the parameters of a selected model (Leach, R2L2, or R3L3)
     based on the provided estimated impedance and estimated Re.
 
+    The real and imaginary parts of the impedance are fitted (fit='complex',
+    or only the modulus with fit='abs'), using the analytic Jacobians of the
+    models. The fit can be done on n_points log-spaced frequencies instead of
+    all the frequency bins.
+
     Usage
     --------------------------------------------------
     # estimated Re from DC measurement
@@ -42,80 +49,237 @@ class Electrical_Impedance:
         estimated Re (from previous measurement)
     params: list
         list of estimated parameters corresponding to the selected model
+    cost : float
+        final value of the cost function (half the sum of squared residuals)
+    PARAMETERS : dict
+        names of the parameters of each model (see also fit_impedances)
 
 
     Methods
     -------
-    costFunction(parameters, omega, Ze_measured)
+    costFunction(parameters, omega, Ze_measured, fit='complex')
         calculates the error between the model and the measured data
-    Leach(omega)
+    jacobian(parameters, omega, Ze_measured, fit='complex')
+        derivatives of the error with respect to the parameters
+    Leach(omega, params=None)
         estimate the impedance from the Leach model
-    R2L2Model(omega)
+    R2L2Model(omega, params=None)
         estimate the impedance from the R2L2 model
-    R3L3Model(omega)
+    R3L3Model(omega, params=None)
         estimate the impedance from the R3L3 model
+    log_subsample(omega, Ze, n_points)
+        log-spaced subset of the frequency bins (static method)
 
     Antonin Novak - 04.10.2022
     '''
 
-    def __init__(self, omega, Ze_measured, Re_estimated, model, guess=False, bounds=False):
+    # names of the parameters of each model
+    PARAMETERS = {'Leach': ('K', 'beta'),
+                  'R2L2': ('Le', 'L2', 'R2'),
+                  'R3L3': ('Le', 'L2', 'R2', 'L3', 'R3')}
+
+    def __init__(self, omega, Ze_measured, Re_estimated, model, guess=False, bounds=False,
+                 fit='complex', n_points=None):
 
         self.Re = Re_estimated
         self.params = guess
 
-        # select the model function
+        # select the model function (and its Jacobian)
         if model == 'Leach':
             self.Ze_model = self.Leach
-            self.guess = guess if guess else [1, 1]
-            self.bounds = bounds if bounds else [10, 10]
+            self.Ze_jacobian = self.LeachJacobian
+            default_guess, default_bounds = [1, 1], [10, 10]
 
-        if model == 'R2L2':
+        elif model == 'R2L2':
             self.Ze_model = self.R2L2Model
-            self.guess = guess if guess else [1e-3, 1e-3, 0.01]
-            self.bounds = bounds if bounds else [10e-3, 10e-3, 10]
+            self.Ze_jacobian = self.R2L2Jacobian
+            default_guess, default_bounds = [1e-3, 1e-3, 0.01], [10e-3, 10e-3, 10]
 
-        if model == 'R3L3':
+        elif model == 'R3L3':
             self.Ze_model = self.R3L3Model
-            self.guess = guess if guess else [1e-3, 1e-3, 0.1, 1e-3, 1]
-            self.bounds = bounds if bounds else [1e-2, 1e-2, 10, 1e-2, 10]
+            self.Ze_jacobian = self.R3L3Jacobian
+            default_guess, default_bounds = [1e-3, 1e-3, 0.1, 1e-3, 1], [1e-2, 1e-2, 10, 1e-2, 10]
+
+        else:
+            raise ValueError(f"Unknown model '{model}' (Leach, R2L2 or R3L3)")
+
+        # guess and bounds can be lists or arrays (False for the defaults of the model)
+        self.guess = default_guess if guess is False else np.asarray(guess, dtype=float)
+        self.bounds = default_bounds if bounds is False else np.asarray(bounds, dtype=float)
+
+        if n_points is not None:
+            omega, Ze_measured = self.log_subsample(omega, Ze_measured, n_points)
+
+        result = least_squares(self.costFunction,
+                               self.guess,
+                               jac=self.jacobian,
+                               bounds=(0, self.bounds),
+                               x_scale='jac',
+                               args=(omega, Ze_measured, fit))
+        self.params = result.x
+        self.cost = result.cost
+
+    def costFunction(self, parameters, omega, Ze_measured, fit='complex'):
+        Fit = self.Ze_model(omega, parameters)
+        if fit == 'abs':
+            return np.abs(Fit) - np.abs(Ze_measured)
+        # stacked real and imaginary parts
+        error = Fit - Ze_measured
+        return np.concatenate((error.real, error.imag))
+
+    def jacobian(self, parameters, omega, Ze_measured, fit='complex'):
+        J = self.Ze_jacobian(omega, parameters)
+        if fit == 'abs':
+            # d|Z| = real(conj(Z) dZ)/|Z|
+            Fit = self.Ze_model(omega, parameters)[:, np.newaxis]
+            return np.real(np.conj(Fit)*J)/np.maximum(np.abs(Fit), np.finfo(float).tiny)
+        return np.concatenate((J.real, J.imag))
+
+    @staticmethod
+    def log_subsample(omega, Ze, n_points):
+        ''' the frequency bins closest to n_points log-spaced frequencies
+            (without the repeated bins at low frequencies and without DC) '''
+        omega = np.asarray(omega)
+        positive = np.flatnonzero(omega > 0)
+        targets = np.geomspace(omega[positive[0]], omega[positive[-1]], n_points)
+        k = np.searchsorted(omega[positive], targets).clip(1, len(positive) - 1)
+        k -= (targets - omega[positive[k - 1]]) < (omega[positive[k]] - targets)
+        k = positive[np.unique(k)]
+        return omega[k], np.asarray(Ze)[k]
+
+    def Leach(self, omega, params=None):
+
+        s = 1j*omega
 
-        self.params = least_squares(self.costFunction,
-                                    self.guess,
-                                    bounds=(0, self.bounds),
-                                    args=(omega, Ze_measured)).x
+        K, beta = self.params if params is None else params
 
-    def costFunction(self, parameters, omega, Ze_measured):
-        self.params = parameters
-        Fit = self.Ze_model(omega)
-        return (np.abs(Ze_measured) - np.abs(Fit))
+        return self.Re + K*s**beta
 
-    def Leach(self, omega):
+    def LeachJacobian(self, omega, params=None):
 
         s = 1j*omega
 
-        K = self.params[0]
-        beta = self.params[1]
+        K, beta = self.params if params is None else params
 
-        return self.Re + K*s**beta
+        s_beta = s**beta
+        log_s = np.log(np.where(s == 0, 1, s))   # s**beta*log(s) -> 0 at DC
 
-    def R2L2Model(self, omega):
+        return np.stack((s_beta, K*s_beta*log_s), axis=-1)
+
+    def R2L2Model(self, omega, params=None):
 
         s = 1j*omega
 
-        Le = self.params[0]
-        L2 = self.params[1]
-        R2 = self.params[2]
+        Le, L2, R2 = self.params if params is None else params
 
         return self.Re + Le*s + s*R2*L2/(R2 + s*L2)
 
-    def R3L3Model(self, omega):
+    def R2L2Jacobian(self, omega, params=None):
 
         s = 1j*omega
 
-        Le = self.params[0]
-        L2 = self.params[1]
-        R2 = self.params[2]
-        L3 = self.params[3]
-        R3 = self.params[4]
+        Le, L2, R2 = self.params if params is None else params
+
+        D2 = (R2 + s*L2)**2
+
+        return np.stack((s, s*R2**2/D2, (s*L2)**2/D2), axis=-1)
+
+    def R3L3Model(self, omega, params=None):
+
+        s = 1j*omega
+
+        Le, L2, R2, L3, R3 = self.params if params is None else params
 
         return self.Re + Le*s + s*R2*L2/(R2 + s*L2) + s*R3*L3/(R3 + s*L3)
+
+    def R3L3Jacobian(self, omega, params=None):
+
+        s = 1j*omega
+
+        Le, L2, R2, L3, R3 = self.params if params is None else params
+
+        D2 = (R2 + s*L2)**2
+        D3 = (R3 + s*L3)**2
+
+        return np.stack((s, s*R2**2/D2, (s*L2)**2/D2, s*R3**2/D3, (s*L3)**2/D3), axis=-1)
+
+
+def fit_impedances(omega, Ze_measured, Re_estimated, model, guess=False, bounds=False,
+                   fit='complex', n_points=None, workers=None, warm_start=True):
+    '''
+    Fits the Electrical_Impedance model to many units at once.
+
+    The units are split into one contiguous group per worker process, the
+    groups are fitted in parallel. Within a group, each fit starts from the
+    solution of the previous unit (warm_start), which is close for units of
+    the same production. A unit with non-finite data (NaN, inf) gets NaN
+    parameters. On Windows, the calling script must be protected by
+    if __name__ == '__main__' (the workers import it).
+
+    Args:
+    - omega (ndarray): Angular frequency (freqs).
+    - Ze_measured (ndarray): Measured impedances (units x freqs).
+    - Re_estimated (float or ndarray): Re of all the units, or of each unit (units).
+    - model (str): 'Leach', 'R2L2' or 'R3L3'.
+    - guess, bounds, fit, n_points: See Electrical_Impedance.
+    - workers (int, optional): Number of processes (os.cpu_count() by default,
+      1 fits in the calling process).
+    - warm_start (bool, optional): Start from the previous unit's solution.
+
+    Returns:
+    - ndarray: Structured array (units) with the fields 'Re', the parameters
+      of the model (Electrical_Impedance.PARAMETERS) and 'residual_norm'.
+
+    Example:
+        fits = fit_impedances(omega, U/I, Re, 'R2L2', n_points=500)
+        print(fits['Le'].mean(), fits['residual_norm'].max())
+        worst = np.argmax(fits['residual_norm'])
+    '''
+    if model not in Electrical_Impedance.PARAMETERS:
+        raise ValueError(f"Unknown model '{model}' (Leach, R2L2 or R3L3)")
+    Ze_measured = np.atleast_2d(Ze_measured)
+    n_units = Ze_measured.shape[0]
+    Re_estimated = np.broadcast_to(np.asarray(Re_estimated, dtype=float), (n_units,))
+
+    # the subsampling is done once, only the needed bins are sent to the workers
+    if n_points is not None:
+        omega, k = Electrical_Impedance.log_subsample(omega, np.arange(len(omega)), n_points)
+        Ze_measured = Ze_measured[:, k]
+
+    workers = min(workers or os.cpu_count() or 1, max(n_units, 1))
+    groups = np.array_split(np.arange(n_units), workers)
+    args = [(omega, Ze_measured[g], Re_estimated[g], model, guess, bounds, fit, warm_start)
+            for g in groups]
+    if workers == 1:
+        results = [_fit_group(*a) for a in args]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_fit_group, *zip(*args)))
+
+    names = Electrical_Impedance.PARAMETERS[model]
+    fits = np.zeros(n_units, dtype=[(name, float) for name in ('Re',) + names + ('residual_norm',)])
+    fits['Re'] = Re_estimated
+    params = np.concatenate([r[0] for r in results])
+    for n, name in enumerate(names):
+        fits[name] = params[:, n]
+    fits['residual_norm'] = np.concatenate([r[1] for r in results])
+    return fits
+
+
+def _fit_group(omega, Ze_measured, Re_estimated, model, guess, bounds, fit, warm_start):
+    ''' fits a group of units one after the other (in a worker process) '''
+    n_params = len(Electrical_Impedance.PARAMETERS[model])
+    params = np.full((len(Ze_measured), n_params), np.nan)
+    norms = np.full(len(Ze_measured), np.nan)
+    start = guess
+    for n, (Ze, Re) in enumerate(zip(Ze_measured, Re_estimated)):
+        if not (np.all(np.isfinite(Ze)) and np.isfinite(Re)):
+            # not finite data, the next unit starts again from the guess
+            start = guess
+            continue
+        result = Electrical_Impedance(omega, Ze, Re, model, guess=start, bounds=bounds, fit=fit)
+        params[n] = result.params
+        norms[n] = np.sqrt(2*result.cost)
+        if warm_start:
+            start = result.params
+    return params, norms
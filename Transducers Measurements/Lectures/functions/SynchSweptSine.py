@@ -0,0 +1,508 @@
+import numpy as np
+import scipy.fft
+from functools import lru_cache
+from .latency import get_latency
+
+
+# maximum number of inverse filters kept in memory
+XINV_CACHE_SIZE = 8
+
+
+@lru_cache(maxsize=XINV_CACHE_SIZE)
+def _Xinv(Npts, f1, L, fs):
+    ''' inverse filter of the swept-sine (cached, read-only) '''
+    import warnings
+    warnings.filterwarnings("ignore")
+    # suppress warnings temporarily (log of zero in Xinv definition)
+
+    # definition of the inferse filter in spectral domain
+    # (Novak et al., "Synchronized swept-sine: Theory, application, and implementation."
+    # Journal of the Audio Engineering Society 63.10 (2015): 786-798.
+    # Eq.(43))
+    f_axis = np.fft.rfftfreq(Npts, d=1.0/fs)
+    Xinv = 2*np.sqrt(f_axis/L)*np.exp(-1j*2*np.pi *
+                                      f_axis*L*(1-np.log(f_axis/f1)) + 1j*np.pi/4)
+    Xinv[0] = 0j
+
+    warnings.filterwarnings("default")
+
+    # the array is shared between calls, it must not be modified
+    Xinv.flags.writeable = False
+    return Xinv
+
+
+class SynchSweptSine:
+    """
+    Synchronous Swept Sine
+
+    The synchronized-swept-sine method is a nonlinear system
+    identification that can analyze a nonlinear system in terms
+    of Higher Harmonic Frequency Responses (HHFRs).
+
+
+    Usage
+    ----------
+    sss = SynchSweptSine(f1, f2, T, fs) # !!! sss is an object
+    x = sss.signal # generates the swept-sine signal
+
+    #                              -------
+    # then do the measurement x -> | NLS | -> y
+    #                              -------
+
+    h = sss.getIR(y) # obtain the impulse response from signal y
+    Hs = sss.separate_IR(h, N=3) # obtain HHFRs
+
+    # several channels can be processed at once (channels x samples),
+    # Hs is then of shape (channels x harmonics x bins)
+    h = sss.getIR(np.array([u, i, x]))
+    Hs = sss.separate_IR(h, N=3)
+
+    # the signal can also be generated block by block
+    for block in sss.signal_blocks(block_size=4096):
+        ... # send the block to the output device
+
+
+    Attributes
+    ----------
+    f1 : float
+        start frequency
+    f2 : float
+        stop frequency
+    fs : fs
+        sample rate
+    T : float
+        time length of the swept-sine
+    fade : [float, float]
+        fade in and fade out in samples
+    L : float
+        sweep rate (speed of sweeping)
+    signal : numpy array
+        synchronized swept-sine signal samples
+        (calculated once and cached, read-only)
+    n_samples : int
+        number of samples of the swept-sine signal
+    precompute : int or None
+        length of the recorded signal (in samples) for which the inverse
+        filter is calculated in advance (when the object is created)
+    workers : int or None
+        number of workers used by scipy.fft (-1 ... all CPU cores)
+    latency : float or None
+        latency of the measurement in samples (can be fractional), if None
+        the latency of device at fs set in this session is used (see
+        functions.latency)
+    device : str, tuple or None
+        acquisition device the latency is looked up for
+
+    Methods
+    -------
+    t_axis()
+        creates the time axis
+    signal_blocks(block_size=4096)
+        generator yielding the swept-sine signal in blocks of block_size samples
+        (the complete signal is never created)
+    Xinv(Npts)
+        calculate the inverse filter (cached, see XINV_CACHE_SIZE)
+        Npts ... number of points
+    getIR(y)
+        get the impulse reponse from the recorded output signal y
+        (y can be 1-D or 2-D with channels along the first axis)
+        y is zero-padded to a fast FFT length (the IR may be a few samples longer)
+    getFRF(y, N_samples=None)
+        get the FRF of the first harmonic only from the signal y
+        N_samples ... impulse response truncation (if not provided fs number of samples is taken)
+    separate_IR(h, N=3, n_samples=2**13, latency=None)
+        separates the higher harmonics impulse responses from the main impulse response h
+        N ... number of harmonics
+        n_samples ... length of the impulse response
+        latency ... latency in the signal (delay in the impulse response h),
+                    the latency attribute by default
+    stream_IR(block_size=2**13)
+        creates a StreamingIR object that deconvolves the recorded signal
+        block by block (while it is being acquired)
+
+    Author:
+        Antonin Novak - 29.10.2021
+
+    """
+
+    def __init__(self, f1=20, f2=20e3, T=10, fs=48e3, fade=[48000, 4800], precompute=None,
+                 workers=None, latency=None, device=None):
+        self.f1 = f1
+        self.f2 = f2
+        self.fs = fs
+        self.T = T
+        self.fade = fade
+        self.L = T/np.log(f2/f1)
+        self.workers = workers
+        self.latency = latency
+        self.device = device
+
+        # inverse filter for the expected length of the recorded signal
+        if precompute:
+            self.Xinv(scipy.fft.next_fast_len(int(precompute), real=True))
+
+    def t_axis(self):
+        ''' creates the time axis '''
+        return np.arange(0, np.round(self.fs*self.T-1)/self.fs, 1/self.fs)
+
+    @property
+    def n_samples(self):
+        ''' number of samples of the swept-sine signal (length of t_axis) '''
+        return int(np.ceil(np.round(self.fs*self.T-1)/self.fs/(1/self.fs)))
+
+    @property
+    def signal(self):
+        ''' generates the swept-sine signal (calculated once, then cached) '''
+        key = (self.f1, self.L, self.fs, self.T, tuple(self.fade))
+        if getattr(self, '_signal_key', None) != key:
+            self._signal = self._samples(0, self.n_samples)
+            # the array is shared between calls, it must not be modified
+            self._signal.flags.writeable = False
+            self._signal_key = key
+        return self._signal
+
+    def signal_blocks(self, block_size=4096):
+        ''' generator of the swept-sine signal in blocks of block_size samples '''
+        for start in range(0, self.n_samples, block_size):
+            yield self._samples(start, min(start + block_size, self.n_samples))
+
+    def _samples(self, start, stop):
+        ''' samples [start, stop) of the swept-sine signal '''
+        n = np.arange(start, stop)
+        n_total = self.n_samples
+
+        # time axis
+        t = n*(1/self.fs)
+
+        # swept-sine
+        s = np.sin(2*np.pi*self.f1*self.L*np.exp(t/self.L))
+
+        # fade-in the input signal
+        if self.fade[0] > 0:
+            k = n < self.fade[0]
+            s[k] = s[k] * \
+                ((-np.cos(n[k]/self.fade[0]*np.pi)+1) / 2)
+
+        # fade-out the input signal
+        if self.fade[1] > 0:
+            k = n >= n_total - self.fade[1]
+            s[k] = s[k] * \
+                ((np.cos((n[k] - n_total + self.fade[1])/self.fade[1]*np.pi)+1) / 2)
+
+        return s
+
+    def Xinv(self, Npts):
+        ''' calculates Xinv = 1/X, where X is the Fourier Transform of the swept-sine
+            (the result is cached and shared, it must not be modified in place) '''
+        return _Xinv(int(Npts), float(self.f1), float(self.L), float(self.fs))
+
+    def f_axis(self, Npts):
+        return np.fft.rfftfreq(Npts, d=1.0/self.fs)
+
+    def getIR(self, y):
+        ''' calculates the impulse repsonse from the measured signal y
+            (the last axis of y is the time axis) '''
+        # the signal is zero-padded to a length for which the FFT is fast
+        Npts = np.shape(y)[-1]
+        Nfft = scipy.fft.next_fast_len(Npts, real=True)
+
+        # FFT of the output signal
+        Y = scipy.fft.rfft(y, Nfft, axis=-1, workers=self.workers)/self.fs
+
+        # complete FRF
+        H = Y*self.Xinv(Nfft)
+
+        # iFFT to get IR
+        # (the IR is periodic, the higher harmonics are at its end,
+        #  the padded samples only extend the gap before them)
+        return scipy.fft.irfft(H, Nfft, axis=-1, workers=self.workers)
+
+    def getFRF(self, y, N_samples=None):
+        ''' Calculates the Frequency Response Function (linear one)
+            of windowed impulse response.
+            Usually used only for linear (or week nonlinear) systems.'''
+        if N_samples == None:
+            N_samples = self.fs
+        h = self.getIR(y)
+        return scipy.fft.rfft(h[..., :int(N_samples)], axis=-1, workers=self.workers)
+
+    def separate_IR(self, h, N=3, n_samples=2**13, latency=None):
+        ''' Separates the nonlinear contributions in the impulse response h
+            and calculates their Fourier Transform to get the Higher Harmonic
+            Frequency Responses (HHFRs).
+            For h of shape (channels x samples) the HHFRs are of shape
+            (channels x harmonics x bins).
+            The latency (in samples) may be fractional, the sub-sample part
+            is compensated together with the non-integer positions.'''
+        if latency is None:
+            latency = self._get_latency()
+        dt = self.L*np.log(np.arange(1, N+1)) * \
+            self.fs  # positions of higher orders up to N
+        # the latency delays all the orders
+        dt = dt - latency
+        # The time lags may be non-integer in samples, the non integer delay must be applied later
+        dt_rem = dt - np.around(dt)
+
+        # number of samples to make an artificail delay
+        shft = int(n_samples/2)
+
+        # separation of higher orders (all orders at once)
+        # the impulse response is periodic, the indexes are taken modulo its length
+        len_h = np.shape(h)[-1]
+        start = len_h - np.around(dt).astype(int) - shft - 1
+        idx = (start[:, np.newaxis] + np.arange(n_samples)) % len_h
+        hs = h[..., idx]    # (..., N, n_samples)
+
+        # Higher Harmonics
+        Hs = scipy.fft.rfft(hs, axis=-1, workers=self.workers)
+
+        # Non integer delay application (one phase matrix for all orders)
+        w_normalized = np.fft.rfftfreq(n_samples, d=1.0/(2*np.pi))
+        Hs *= np.exp(-1j*dt_rem[:, np.newaxis]*w_normalized)
+
+        # the Nyquist bin of a real signal is real
+        if n_samples % 2 == 0:
+            Hs[..., -1] = Hs[..., -1].real
+        return Hs
+
+    def _get_latency(self):
+        ''' latency attribute, or the latency of device at fs if it is None '''
+        return get_latency(self.fs, self.device) if self.latency is None else self.latency
+
+    def stream_IR(self, block_size=2**13):
+        ''' creates a streaming deconvolver (see StreamingIR) '''
+        return StreamingIR(self, block_size=block_size)
+
+
+class StreamingIR:
+    """
+    Streaming deconvolution of the swept-sine response
+
+    The recorded signal is convolved block by block with the time-domain
+    inverse filter of the swept-sine, using a uniformly partitioned
+    convolution: the spectrum of each new block is multiplied by all the
+    filter partitions at once and the products are accumulated in the
+    spectra of the output blocks they belong to. The impulse response is
+    thus calculated while the signal is being acquired; once the last block
+    has arrived, only the inverse FFTs of the pending output blocks remain
+    (one batched call, about half of the work of getIR on the recording).
+
+    The inverse filter is truncated to the negative times corresponding
+    to frequencies up to fs/2 (where the higher harmonics are) and to
+    `block_size` samples of positive times.
+
+
+    Usage
+    ----------
+    sss = SynchSweptSine(f1, f2, T, fs)
+    stream = sss.stream_IR(block_size=2**13)
+
+    for y_block in blocks: # blocks of samples as they arrive
+        stream.process(y_block)
+
+    h = stream.getIR() # same arrangement as sss.getIR(y)
+    Hs = sss.separate_IR(h, N=3)
+
+
+    Attributes
+    ----------
+    sss : SynchSweptSine
+        the swept-sine object
+    block_size : int
+        number of samples processed at once (size of the filter partitions)
+    n_pre : int
+        number of samples of negative time kept in the inverse filter
+
+    Methods
+    -------
+    process(y)
+        adds the new samples y (1-D or channels x samples) and returns
+        the new output samples of the convolution
+    finish()
+        processes the remaining samples and the tail of the convolution
+        (no samples can be added afterwards)
+    getIR()
+        finishes the stream and returns the impulse response arranged as by
+        SynchSweptSine.getIR (periodic of the length of the recording,
+        positive times first, negative times at the end)
+
+    """
+
+    def __init__(self, sss, block_size=2**13):
+        self.sss = sss
+        self.block_size = B = int(block_size)
+        # negative times of the inverse filter up to the Nyquist frequency
+        # (distortion products above f2 are deconvolved as with getIR)
+        self.n_pre = int(np.ceil(sss.L*np.log(sss.fs/2/sss.f1)*sss.fs)) + B
+
+        # time-domain inverse filter (long enough to avoid time aliasing)
+        Nfilt = scipy.fft.next_fast_len(4*self.n_pre, real=True)
+        g = scipy.fft.irfft(sss.Xinv(Nfilt), Nfilt, workers=sss.workers)/sss.fs
+
+        # truncation: negative times first (the filter becomes causal)
+        g = np.concatenate((g[-self.n_pre:], g[:B]))
+
+        # filter partitions of B samples in the frequency domain
+        P = -(-len(g)//B)
+        g = np.concatenate((g, np.zeros(P*B - len(g)))).reshape(P, B)
+        self._G = scipy.fft.rfft(g, 2*B, axis=-1, workers=sss.workers)
+
+        # spectra of the next P output blocks (ring buffer, the output block
+        # q is at the position q % P) and the overlapping half of the last one
+        self._acc = None
+        self._carry = None
+        self._n_blocks = 0
+        self._buffer = []
+        self._n_in = 0
+        self._out = []
+        self._finished = False
+
+    def process(self, y):
+        ''' adds the samples y and returns the newly available output samples '''
+        if self._finished:
+            raise ValueError("The stream is finished, no samples can be added")
+        y = np.asarray(y, dtype=float)
+        self._buffer.append(y)
+        self._n_in += y.shape[-1]
+
+        buffer = np.concatenate(self._buffer, axis=-1)
+        n_blocks = buffer.shape[-1]//self.block_size
+        out = [self._process_block(buffer[..., k*self.block_size:(k+1)*self.block_size])
+               for k in range(n_blocks)]
+        self._buffer = [buffer[..., n_blocks*self.block_size:]]
+
+        if not out:
+            return np.zeros(buffer.shape[:-1] + (0,))
+        return np.concatenate(out, axis=-1)
+
+    @property
+    def _n_total(self):
+        ''' length of the complete (linear) convolution '''
+        return self._n_in + self.n_pre + self.block_size - 1
+
+    def finish(self):
+        ''' processes the remaining samples and the rest of the convolution
+            (the positive times of the IR come out of the filter n_pre samples
+            late), returns the last output samples '''
+        n_out, n_rem = len(self._out), self._n_total - self.block_size*self._n_blocks
+        self._finish()
+        if len(self._out) == n_out:
+            return np.zeros(np.shape(self._buffer[0])[:-1] + (0,))
+        return np.concatenate(self._out[n_out:], axis=-1)[..., :n_rem]
+
+    def _finish(self):
+        if self._finished:
+            return
+        self._finished = True
+        buffer = np.concatenate(self._buffer, axis=-1)
+        self._buffer = [buffer[..., :0]]
+
+        # the last (incomplete) block
+        B = self.block_size
+        if buffer.shape[-1] > 0:
+            pad = np.zeros(buffer.shape[:-1] + (B - buffer.shape[-1],))
+            self._process_block(np.concatenate((buffer, pad), axis=-1))
+        if self._acc is None:
+            return
+
+        # the pending output blocks only need their inverse FFTs (all at once,
+        # in the order of the ring, the zeroed entry of the next block included)
+        P = self._G.shape[0]
+        tail = scipy.fft.irfft(self._acc, 2*B, axis=-1, workers=self.sss.workers)
+        carry = self._carry
+        for q in range(self._n_blocks, self._n_blocks + P):
+            block = tail[..., q % P, :B]
+            block += carry
+            carry = tail[..., q % P, B:]
+            self._out.append(block)
+
+    def getIR(self):
+        ''' finishes the stream and returns the impulse response '''
+        self._finish()
+        n_in, n_total = self._n_in, self._n_total
+
+        # output sample m corresponds to the time m - n_pre of the IR, the IR
+        # is folded to the length of the recording (periodic, as by getIR):
+        # the times t >= 0 first, the negative times wrapped at the end
+        h = np.zeros(self._out[0].shape[:-1] + (n_in,))
+        m = 0
+        for out in self._out:
+            out = out[..., :n_total - m]
+            start = 0
+            while start < out.shape[-1]:
+                k = (m + start - self.n_pre) % n_in
+                n = min(n_in - k, out.shape[-1] - start)
+                h[..., k:k + n] += out[..., start:start + n]
+                start += n
+            m += out.shape[-1]
+        return h
+
+    def _process_block(self, y_block):
+        B = self.block_size
+        P = self._G.shape[0]
+        if self._acc is None:
+            self._acc = np.zeros(y_block.shape[:-1] + self._G.shape, dtype=complex)
+            self._carry = np.zeros(y_block.shape)
+
+        # the block j contributes to the output blocks j ... j+P-1 (the p-th
+        # partition to the block j+p), added in the two parts of the ring
+        X = scipy.fft.rfft(y_block, 2*B, axis=-1, workers=self.sss.workers)[..., np.newaxis, :]
+        j = self._n_blocks % P
+        self._acc[..., j:, :] += X*self._G[:P - j]
+        self._acc[..., :j, :] += X*self._G[P - j:]
+
+        # the output block j is complete (overlap-add of its two halves)
+        y = scipy.fft.irfft(self._acc[..., j, :], 2*B, axis=-1, workers=self.sss.workers)
+        out = y[..., :B] + self._carry
+        self._carry = y[..., B:]
+        self._acc[..., j, :] = 0
+        self._n_blocks += 1
+
+        self._out.append(out)
+        return out
+
+
+if __name__ == "__main__":
+
+    # check of the streaming deconvolution against SynchSweptSine.getIR
+    # (run from the Work folder: python -m functions.SynchSweptSine)
+    sss = SynchSweptSine(f1=20, f2=20e3, T=2, fs=48000)
+    x = sss.signal
+    y = np.concatenate((x + 0.1*x**2 + 0.05*x**3, np.zeros(1000)))
+
+    stream = sss.stream_IR(block_size=2**12)
+    for k in range(0, len(y), 3000):
+        stream.process(y[k:k + 3000])
+
+    Hs_stream = sss.separate_IR(stream.getIR(), N=3, latency=0)
+    Hs = sss.separate_IR(sss.getIR(y), N=3, latency=0)
+    f_axis = np.fft.rfftfreq(2**13, 1/sss.fs)
+    band = (f_axis > 2*sss.f1) & (f_axis < sss.f2/4)
+    error = np.max(np.abs(Hs_stream[:, band] - Hs[:, band]))/np.max(np.abs(Hs[0, band]))
+    print(f'maximum difference of the HHFRs: {error:.2e}')
+    assert error < 1e-3
+
+    # timing: the work left once the last block has arrived must be shorter
+    # than getIR on the whole recording (10 s swept-sine, 3 channels)
+    import time
+    sss = SynchSweptSine(f1=20, f2=20e3, T=10, fs=48000)
+    y = np.concatenate((sss.signal, np.zeros(24000)))*np.array([[1], [0.5], [0.1]])
+    sss.getIR(y)    # the inverse filter is cached
+    t_getIR, t_stream, t_finish = np.inf, np.inf, np.inf
+    for _ in range(3):
+        start = time.perf_counter()
+        sss.getIR(y)
+        t_getIR = min(t_getIR, time.perf_counter() - start)
+
+        stream = sss.stream_IR(block_size=2**13)
+        start = time.perf_counter()
+        for k in range(0, y.shape[-1], 4800):
+            stream.process(y[:, k:k + 4800])
+        t_stream = min(t_stream, time.perf_counter() - start)
+        start = time.perf_counter()
+        stream.getIR()
+        t_finish = min(t_finish, time.perf_counter() - start)
+
+    print(f'getIR: {1e3*t_getIR:.0f} ms, streaming (during the acquisition): '
+          f'{1e3*t_stream:.0f} ms, after the last block: {1e3*t_finish:.0f} ms')
+    assert t_finish < t_getIR
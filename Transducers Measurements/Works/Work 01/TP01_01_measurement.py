@@ -48,17 +48,16 @@ x = np.concatenate((np.zeros(10000), sss.signal, np.zeros(10000)))
 """ Measurement  """
 y = measurement_NI(0.5*x, fs, Dev)
 # voltage [V] (time domain signal)
-u = voltage_sensitivity * np.array(y[0])
+u = voltage_sensitivity * y[0]
 # current [A] (time domain signal)
-i = current_sensitivity * np.array(y[1])
+i = current_sensitivity * y[1]
 # displacement [m] (time domain signal)
-x = displacement_sensitivity * np.array(y[2])
+x = displacement_sensitivity * y[2]
 
 
 """ Extract spectra from swept-sine  """
-U = sss.getFRF(u, fs)          # voltage [V] (frequency domain)
-I = sss.getFRF(i, fs)          # current [A] (frequency domain)
-X = sss.getFRF(x, fs)          # displacement [m] (frequency domain)
+# all channels are processed at once (voltage [V], current [A], displacement [m])
+U, I, X = sss.getFRF(np.array([u, i, x]), fs)  # (frequency domain)
 f_axis = sss.f_axis(fs)
 
 """ SAVE  """
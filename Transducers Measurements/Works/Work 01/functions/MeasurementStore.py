@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import shutil
+import datetime
+import numpy as np
+
+
+class MeasurementStore:
+    """
+    Chunked measurement store (a folder of arrays and a JSON sidecar)
+
+    Each channel (or result) is written as a series of chunks along its first
+    axis: raw .npy files, opened with mmap_mode when read, or compressed .npz
+    files. The metadata (fs, sensitivities, excitation parameters, device,
+    timestamp, ...) is kept in a JSON sidecar, readable without numpy. Long
+    recordings can be written block by block while they are acquired, and
+    sliced later without loading the whole recording in memory.
+
+
+    Usage
+    ----------
+    # write (the channels can be written at once, or appended block by block)
+    with MeasurementStore.create('results_part_3/creep', fs=fs, device=Dev,
+                                 sensitivities={'u': 1, 'i': 1, 'x': 2e-3}) as store:
+        store.append('u', u)
+        store.append('i', i)
+
+    # read (the raw chunks are memory-mapped)
+    store = MeasurementStore.open('results_part_3/creep')
+    fs = store.metadata['fs']
+    u = store['u'][10*fs:20*fs]   # only the needed chunks are read
+    u = np.asarray(store['u'])    # whole channel
+
+
+    Attributes
+    ----------
+    path : str
+        folder of the store
+    metadata : dict
+        metadata of the measurement (saved in metadata.json)
+    channels : list of str
+        names of the stored channels
+    chunk_size : int
+        number of rows (samples) of each chunk
+    compress : bool
+        the chunks are compressed (they can not be memory-mapped)
+
+    Methods
+    -------
+    create(path, chunk_size=2**20, compress=False, overwrite=False, **metadata)
+        creates a new store (class method)
+    open(path)
+        opens an existing store (class method)
+    append(name, data)
+        appends data to the channel name (along the first axis)
+    flush()
+        writes the pending data and the sidecar
+    close()
+        flushes the store
+
+    """
+
+    SIDECAR = 'metadata.json'
+
+    def __init__(self, path, metadata, channels, chunk_size, compress, writable):
+        self.path = path
+        self.metadata = metadata
+        self.chunk_size = int(chunk_size)
+        self.compress = compress
+        self._channels = channels
+        self._writable = writable
+        self._pending = {}
+
+    @classmethod
+    def create(cls, path, chunk_size=2**20, compress=False, overwrite=False, **metadata):
+        ''' creates a new (empty) store in the folder path
+            (an existing store is replaced if overwrite is True) '''
+        if overwrite and os.path.isfile(os.path.join(path, cls.SIDECAR)):
+            shutil.rmtree(path)
+        os.makedirs(path, exist_ok=False)
+        metadata.setdefault('timestamp', datetime.datetime.now().isoformat())
+        store = cls(path, metadata, {}, chunk_size, compress, writable=True)
+        store._write_sidecar()
+        return store
+
+    @classmethod
+    def open(cls, path):
+        ''' opens an existing store (read only) '''
+        with open(os.path.join(path, cls.SIDECAR)) as file:
+            sidecar = json.load(file)
+        return cls(path, sidecar['metadata'], sidecar['channels'],
+                   sidecar['chunk_size'], sidecar['compress'], writable=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def channels(self):
+        return list(self._channels)
+
+    def __contains__(self, name):
+        return name in self._channels
+
+    def __getitem__(self, name):
+        ''' channel name as a ChunkedArray (sliced without loading everything) '''
+        if name not in self._channels:
+            raise KeyError(name)
+        info = self._channels[name]
+        files = [os.path.join(self.path, name, f) for f in info['chunks']]
+        return ChunkedArray(files, info['lengths'], info['dtype'], info['shape'])
+
+    def append(self, name, data):
+        ''' appends data to the channel name (along the first axis) '''
+        if not self._writable:
+            raise ValueError("The store is opened read only")
+        data = np.asarray(data)
+        if data.ndim == 0:
+            data = data[np.newaxis]
+
+        if name not in self._channels:
+            os.makedirs(os.path.join(self.path, name))
+            self._channels[name] = {'dtype': data.dtype.str, 'shape': list(data.shape[1:]),
+                                    'chunks': [], 'lengths': []}
+            self._pending[name] = []
+        info = self._channels[name]
+        if list(data.shape[1:]) != info['shape']:
+            raise ValueError(f"The data of '{name}' must be of shape (n, {info['shape']})")
+
+        # complete chunks are written at once, the rest stays pending
+        pending = self._pending[name]
+        pending.append(data)
+        n_pending = sum(len(p) for p in pending)
+        if n_pending >= self.chunk_size:
+            data = np.concatenate(pending).astype(info['dtype'], copy=False)
+            n_full = len(data)//self.chunk_size*self.chunk_size
+            for start in range(0, n_full, self.chunk_size):
+                self._write_chunk(name, data[start:start + self.chunk_size])
+            self._pending[name] = [data[n_full:]] if n_full < len(data) else []
+            self._write_sidecar()
+
+    def flush(self):
+        ''' writes the pending data of all the channels and the sidecar '''
+        if not self._writable:
+            return
+        for name, pending in self._pending.items():
+            if pending:
+                data = np.concatenate(pending).astype(self._channels[name]['dtype'], copy=False)
+                self._write_chunk(name, data)
+                self._pending[name] = []
+        self._write_sidecar()
+
+    def close(self):
+        self.flush()
+        self._writable = False
+
+    def _write_chunk(self, name, data):
+        info = self._channels[name]
+        index = len(info['chunks'])
+        if self.compress:
+            filename = f'chunk_{index:06d}.npz'
+            np.savez_compressed(os.path.join(self.path, name, filename), data=data)
+        else:
+            filename = f'chunk_{index:06d}.npy'
+            np.save(os.path.join(self.path, name, filename), data)
+        info['chunks'].append(filename)
+        info['lengths'].append(len(data))
+
+    def _write_sidecar(self):
+        ''' the sidecar is replaced atomically (it stays valid if the writing stops) '''
+        sidecar = {'metadata': self.metadata, 'channels': self._channels,
+                   'chunk_size': self.chunk_size, 'compress': self.compress}
+        filename = os.path.join(self.path, self.SIDECAR)
+        with open(filename + '.tmp', 'w') as file:
+            json.dump(sidecar, file, indent=2, default=_to_json)
+        os.replace(filename + '.tmp', filename)
+
+
+class ChunkedArray:
+    """
+    Read-only array stored in chunks along its first axis
+
+    Indexing along the first axis reads only the chunks that are needed (the
+    .npy chunks are memory-mapped), np.asarray() reads the whole array.
+
+    """
+
+    def __init__(self, files, lengths, dtype, shape):
+        self.files = files
+        self.lengths = list(lengths)
+        self.offsets = np.concatenate(([0], np.cumsum(self.lengths, dtype=np.int64)))
+        self.dtype = np.dtype(dtype)
+        self.shape = (int(self.offsets[-1]),) + tuple(shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[:]
+        return data if dtype is None else data.astype(dtype)
+
+    def __getitem__(self, key):
+        rest = ()
+        if isinstance(key, tuple):
+            key, rest = key[0], key[1:]
+
+        if isinstance(key, (int, np.integer)):
+            if key < 0:
+                key += len(self)
+            if not 0 <= key < len(self):
+                raise IndexError("index out of range")
+            k = np.searchsorted(self.offsets, key, side='right') - 1
+            return self._chunk(k)[(key - self.offsets[k],) + rest]
+
+        if not isinstance(key, slice):
+            raise TypeError("only integers and slices are supported along the first axis")
+
+        start, stop, step = key.indices(len(self))
+        if step < 0:
+            return self[stop + 1:start + 1][::step][(slice(None),) + rest]
+        stop = max(start, stop)
+
+        # chunks that contain [start, stop)
+        k1 = np.searchsorted(self.offsets, start, side='right') - 1
+        k2 = np.searchsorted(self.offsets, stop, side='left')
+        parts = [self._chunk(k) for k in range(max(k1, 0), k2)]
+        if len(parts) == 0:
+            data = np.empty((0,) + self.shape[1:], dtype=self.dtype)
+        elif len(parts) == 1:
+            data = parts[0]
+        else:
+            data = np.concatenate(parts)
+
+        first = self.offsets[max(k1, 0)] if len(parts) else 0
+        return data[(slice(start - first, stop - first, step),) + rest]
+
+    def _chunk(self, k):
+        if self.files[k].endswith('.npz'):
+            with np.load(self.files[k]) as data:
+                return data['data']
+        return np.load(self.files[k], mmap_mode='r')
+
+
+def _to_json(value):
+    ''' numpy values in the metadata '''
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f"{type(value)} can not be saved in the metadata")
@@ -24,7 +24,7 @@ Author:
 
 import numpy as np
 import matplotlib.pyplot as plt
-from functions.measurement_NI import measurement_NI
+from functions.measurement_NI import MeasurementSession
 from functions.SynchSweptSine import SynchSweptSine
 
 
@@ -52,19 +52,23 @@ U, I, X = [], [], []
 
 
 """ Measurement  """
-for A in amplitudes:
-
-    y = measurement_NI(A*out_signal, fs, Dev)
-
-    ''' Extract signals from measured data '''
-    u = voltage_sensitivity * np.array(y[0])       # voltage [V]
-    i = current_sensitivity * np.array(y[1])       # current [A]
-    x = displacement_sensitivity * np.array(y[2])  # displacement [m]
-
-    ''' Extract spectra from swept-sine  '''
-    U.append(sss.getFRF(u, fs)[:1000])  # voltage [V] (frequency domain)
-    I.append(sss.getFRF(i, fs)[:1000])  # current [A] (frequency domain)
-    X.append(sss.getFRF(x, fs)[:1000])  # displacement [m] (frequency domain)
+# the NI device is configured once for all the amplitudes
+# (and released even if the measurement stops with an error)
+with MeasurementSession(fs, Dev) as session:
+    for A in amplitudes:
+
+        y = session.measure(A*out_signal)
+
+        ''' Extract signals from measured data '''
+        u = voltage_sensitivity * y[0]       # voltage [V]
+        i = current_sensitivity * y[1]       # current [A]
+        x = displacement_sensitivity * y[2]  # displacement [m]
+
+        ''' Extract spectra from swept-sine (all channels at once) '''
+        Ua, Ia, Xa = sss.getFRF(np.array([u, i, x]), fs)[:, :1000]
+        U.append(Ua)  # voltage [V] (frequency domain)
+        I.append(Ia)  # current [A] (frequency domain)
+        X.append(Xa)  # displacement [m] (frequency domain)
 
 
 # frequency axis
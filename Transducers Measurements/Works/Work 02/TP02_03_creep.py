@@ -23,6 +23,7 @@ Author:
 import numpy as np
 import matplotlib.pyplot as plt
 from functions.measurement_NI import measurement_NI
+from functions.MeasurementStore import MeasurementStore
 
 
 """ Parameters """
@@ -43,16 +44,23 @@ output = np.zeros(5*60*fs)
 """ Measurement  """
 y = measurement_NI(output, fs, Dev)
 
-u = voltage_sensitivity * np.array(y[0])  # voltage [V] (time domain signal)
-i = current_sensitivity * np.array(y[1])  # current [A] (time domain signal)
-x = np.array(y[2]) - displacement_DC_offset
+u = voltage_sensitivity * y[0]  # voltage [V] (time domain signal)
+i = current_sensitivity * y[1]  # current [A] (time domain signal)
+x = y[2] - displacement_DC_offset
 x *= displacement_sensitivity  # displacement [m] (time domain signal)
 
 t = np.arange(0, len(u))/fs  # time axis [s]
 
 
 """ SAVE  """
-np.savez('results_part_3/meas_data_up.npz', u=u, i=i, x=x)
+# chunked store, the channels can be sliced later with MeasurementStore.open(...)['u'][a:b]
+sensitivities = {'u': voltage_sensitivity, 'i': current_sensitivity, 'x': displacement_sensitivity}
+with MeasurementStore.create('results_part_3/meas_data_up', overwrite=True, fs=fs, device=Dev,
+                             sensitivities=sensitivities,
+                             displacement_DC_offset=displacement_DC_offset) as store:
+    store.append('u', u)  # voltage [V]
+    store.append('i', i)  # current [A]
+    store.append('x', x)  # displacement [m]
 
 
 """ PLOT  """
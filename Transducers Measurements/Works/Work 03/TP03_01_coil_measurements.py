@@ -25,6 +25,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 from functions.measurement_NI import measurement_NI
 from functions.Multitone import Multitone
+from functions.ResultsIndex import ResultsIndex, save_result
 
 """ Parameters """
 Dev = 'Dev6'  # name of the NI device
@@ -44,9 +45,9 @@ multitone = Multitone(f1=10, f2=20e3, N=100, T=3, fs=fs)
 y = measurement_NI(0.9*multitone.signal, fs, Dev)
 
 # voltage [V] (time domain signal)
-u = voltage_sensitivity*np.array(y[0])
+u = voltage_sensitivity*y[0]
 # current [A] (time domain signal)
-i = current_sensitivity*np.array(y[1])
+i = current_sensitivity*y[1]
 
 """ Calculate the FFT """
 U = multitone.extract_spectra(u)
@@ -54,8 +55,11 @@ I = multitone.extract_spectra(i)
 f_axis = multitone.frequencies
 
 """ SAVE  """
-np.savez('results_part_1/coil_in_air.npz',
-         f_axis=f_axis, fs=fs, U=U, I=I)
+# the result is also added to the index (query it instead of listing the files)
+index = ResultsIndex('results/index.sqlite')
+save_result('results_part_1/coil_in_air.npz', index, label='in air',
+            excitation='multitone', level=np.std(u), setup='air',
+            f_axis=f_axis, fs=fs, U=U, I=I)
 
 
 """ Apparent Resistance and Inductance  """
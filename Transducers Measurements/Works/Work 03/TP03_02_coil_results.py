@@ -25,6 +25,11 @@ files = []
 files.append(('results_part_1/coil_in_air.npz', 'in air'))
 # files.append(('results_part_1/coil_in_motor.npz', 'in motor'))
 
+# or select the results from the index (the files are not opened), e.g.
+# from functions.ResultsIndex import ResultsIndex
+# files = ResultsIndex('results/index.sqlite').files(
+#     "excitation = 'multitone' AND setup = ? AND level > ?", ('iron', 1))
+
 plot_ReLe(files, ylim_Re=[0, 10], ylim_Le=[0, 2])
 
 
@@ -25,6 +25,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 from functions.measurement_NI import measurement_NI
 from functions.Multitone import Multitone
+from functions.ResultsIndex import ResultsIndex, save_result, thd
 
 """ Parameters """
 Dev = 'Dev6'  # name of the NI device
@@ -47,17 +48,21 @@ x = np.sin(2*np.pi*f0*t)
 y = measurement_NI(0.9*x, fs, Dev)
 
 # voltage [V] (time domain signal, only last second)
-u = voltage_sensitivity*np.array(y[0])[-fs:]
+u = voltage_sensitivity*y[0][-fs:]
 # current [A] (time domain signal, only last second)
-i = current_sensitivity*np.array(y[1])[-fs:]
+i = current_sensitivity*y[1][-fs:]
 
 """ Calculate the FFT """
 U = np.fft.rfft(u)/len(u)*2
 I = np.fft.rfft(i)/len(u)*2
 f_axis = np.fft.rfftfreq(fs, 1/fs)
 
-np.savez('results_part_2/coil_in_air.npz',
-         f_axis=f_axis, fs=fs, U=U, I=I)
+# the result is also added to the index (with the THD of the current)
+index = ResultsIndex('results/index.sqlite')
+save_result('results_part_2/coil_in_air.npz', index, label='in air',
+            excitation='sine', level=np.std(u), setup='air',
+            metadata={'f0': f0, 'THD': thd(f_axis, I, f0)},
+            f_axis=f_axis, fs=fs, U=U, I=I)
 
 
 """ Plot the results """
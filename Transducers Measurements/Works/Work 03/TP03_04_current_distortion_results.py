@@ -22,6 +22,10 @@ files = []
 files.append(('results_part_2/coil_in_air.npz', 'air'))
 # files.append(('results_part_2/coil_in_iron.npz', 'motor'))
 
+# or select the results from the index (the files are not opened), e.g.
+# from functions.ResultsIndex import ResultsIndex
+# files = ResultsIndex('results/index.sqlite').files("excitation = 'sine'", order_by='level')
+
 plot_current_spec(files, n_rows_max=2)
 
 plt.show()
@@ -1,4 +1,9 @@
+import time
+import warnings
 import numpy as np
+import scipy.fft
+from .PeriodAverager import PeriodAverager
+from .latency import get_latency
 
 
 class Multitone:
@@ -7,11 +12,11 @@ class Multitone:
 
     A multitone signal allows to measure the Device Under Test (DUT)
     over a range of frequencies with a single measurement. The multitone
-    consists of N integer frequencies logarithmically spaced between
-    the defined frequencies f1 and f2. The time-length of the signal must be
-    an at least two seconds. At least one second is omitted from the signal
-    to deal with the latency of the system at to let the DUT to come to
-    a steady state.
+    consists of N frequencies logarithmically spaced between the defined
+    frequencies f1 and f2, rounded to the multiples of 1/Tp (the signal is
+    periodic with the period Tp, 1 second by default). The first (T-Tx)
+    seconds of the signal are omitted to deal with the latency of the system
+    and to let the DUT to come to a steady state.
 
 
     Usage
@@ -28,11 +33,31 @@ class Multitone:
     # then do the measurement x -> | DUT | -> y
     #                              -------
 
+    # or generate it block by block (e.g. for a long signal)
+    for block in multitone.signal_blocks(block_size=4096):
+        ... # send the block to the output device
+
     # get the output spectra relative to the input signal
     # (FRF-like between fft(y)/fft(x) provided onl)
     # Hy has the same size as multitone.frequencies
     Hy = multitone.extract_spectra(y)
 
+    # or average the last P periods and get the noise and distortion levels
+    # (odd=True puts the tones on odd bins only, the even-order distortion
+    #  then appears at the even bins and the odd-order at the odd ones)
+    multitone = Multitone(f1=20, f2=20e3, N=100, T=5, fs=fs, Tx=4, odd=True)
+    result = multitone.analyze_periods(y, P=4)
+    Hy, noise = result['H'], result['noise']
+
+    # or average the periods while the signal is being acquired
+    avg = multitone.averager()
+    for y_block in blocks:
+        avg.process(y_block)
+    Hy = multitone.extract_spectra(avg.mean)
+
+    # short periods for fast measurements (250 ms period, 4 Hz grid)
+    multitone = Multitone(f1=20, f2=20e3, N=100, T=0.75, fs=fs, Tx=0.5, Tp=0.25)
+
 
     Attributes
     ----------
@@ -46,24 +71,58 @@ class Multitone:
         length of the signal (in seconds)
     fs : int
         sample rate
+    Tp : float
+        period of the signal (in seconds), the frequencies are multiples of 1/Tp
     frequencies : numpy array
-        integer frequencies
+        frequencies (multiples of 1/Tp)
+    bins : numpy array
+        FFT bins of the frequencies in one period of the signal
+    odd : bool
+        only odd frequencies are used (odd multisine)
+    phase : str
+        phase strategy ('random', 'schroeder', 'newman' or 'optimized')
     random_phase : numpy array
-        random phase of each frequency
+        phase of each frequency (random or given by the phase strategy)
+    crest_factor : float
+        crest factor of the signal (peak value / rms value)
+    signal : numpy array
+        multitone signal samples (calculated once and cached, read-only)
+    spectrum : numpy array
+        spectrum of the signal at the frequencies (cached)
+    workers : int or None
+        number of workers used by scipy.fft (-1 ... all CPU cores)
+    latency : float or None
+        latency of the measurement in samples, compensated in the spectra
+        (if None the latency of device at fs set in this session is used,
+        see functions.latency)
+    device : str, tuple or None
+        acquisition device the latency is looked up for
 
 
     Methods
     ----------
     set_frequencies()
-        set the actual frequencies
+        set the actual frequencies (returns their FFT bins in one period)
+    set_phases(phase='random', n_iter=100, max_time=None)
+        set the phases of the frequencies
+    signal_blocks(block_size=4096)
+        generator yielding the multitone signal in blocks of block_size samples
+        (the complete signal is never created)
     extract_spectra(y)
         get the spectra of the output signal y relative to input signal
         (similar to FRF = Y/X)
+    analyze_periods(y, P=None)
+        synchronous average of the spectra of the last P periods of y,
+        together with the noise level and the distortion (non-excited bins)
+    averager()
+        creates a PeriodAverager for the streaming average of the periods
 
     Antonin Novak - 04.10.2022
     '''
 
-    def __init__(self, f1=20, f2=20e3, N=100, T=2, fs=48000, Tx=1):
+    def __init__(self, f1=20, f2=20e3, N=100, T=2, fs=48000, Tx=1, workers=None,
+                 phase='random', n_iter=100, max_time=None, odd=False, Tp=1, latency=None,
+                 device=None):
         """
         Parameters
         ----------
@@ -77,13 +136,51 @@ class Multitone:
             length of the signal (in seconds)
         fs : int
             sample rate
-        Tx : int
-            length of the signal to calculate the 
+        Tx : float
+            length of the signal to calculate the spectra
             (T-Tx) is removed from the beginning of signal
+            must be an integer number of periods Tp
+        workers : int or None
+            number of workers used by scipy.fft (-1 ... all CPU cores)
+            the FFT length is Tx*fs, it is not zero-padded
+            (padding would move the tones out of the FFT bins)
+        phase : str
+            phases of the frequencies, to reduce the crest factor of the signal
+            'random'    ... uniformly distributed random phases
+            'schroeder' ... Schroeder phases, -2*pi*sum((f_k - f_l)/N, l < k)
+                            (-pi*k*(k-1)/N for consecutive frequencies)
+            'newman'    ... Newman phases, pi*(k-1)**2/N (k is the tone index)
+                            'schroeder' and 'newman' reduce the crest factor only
+                            for (nearly) uniformly spaced frequencies (e.g. a
+                            narrow band or a linear grid); on the logarithmic
+                            grid of a wide band they are worse than the random
+                            phases, a warning is issued in that case
+            'optimized' ... iterative clipping of the signal (starting from
+                            the Schroeder or random phases, whichever has
+                            the lower crest factor), see n_iter and max_time
+        n_iter : int
+            maximum number of iterations of the 'optimized' phases
+        max_time : float or None
+            maximum time (in seconds) spent on the 'optimized' phases
+        odd : bool
+            the frequencies are rounded to odd multiples of 1/Tp (odd multisine),
+            so that the even and odd distortion products can be separated
+        Tp : float
+            period of the signal (in seconds), Tp*fs must be an integer
+            the frequency resolution is 1/Tp
+        latency : float or None
+            latency of the measurement in samples (can be fractional), its
+            phase is removed from the spectra; if None the latency of device
+            at fs set in this session is used (0 if it is not known)
+        device : str, tuple or None
+            acquisition device the latency is looked up for
 
         """
-        if not isinstance(Tx, int):
-            raise TypeError(f"Tx must be an integer.")
+        if not np.isclose(Tp*fs, np.round(Tp*fs)):
+            raise ValueError("The period Tp must be an integer number of samples")
+
+        if not np.isclose(Tx/Tp, np.round(Tx/Tp)) or np.round(Tx/Tp) < 1:
+            raise ValueError("Time Tx must be an integer number of periods Tp")
 
         if (Tx > T):
             raise ValueError("Time T must be longer than time Tx")
@@ -93,38 +190,232 @@ class Multitone:
         self.T = T
         self.N = N
         self.fs = fs
-        self.frequencies = self.set_frequencies()
-        self.random_phase = 2*np.pi*np.random.rand(len(self.frequencies))
         self.Tx = Tx
+        self.Tp = Tp
+        self.workers = workers
+        self.odd = odd
+        self.latency = latency
+        self.device = device
+        self.bins = self.set_frequencies()
+        self.frequencies = self.bins/Tp
+        self.phase = phase
+        self.random_phase = self.set_phases(phase, n_iter, max_time)
 
     def set_frequencies(self):
         # creat the frequencies
         f1_log = np.log10(self.f1)
         f2_log = np.log10(self.f2)
         frequencies = np.logspace(f1_log, f2_log, self.N, endpoint=True)
-        return np.unique(np.round(frequencies)).astype(np.uint)
+
+        # frequencies rounded to the frequency grid (multiples of 1/Tp)
+        bins = frequencies*self.Tp
+        if self.odd:
+            return np.unique(2*np.round((bins-1)/2)+1).astype(int)
+        return np.unique(np.round(bins)).astype(int)
+
+    def set_phases(self, phase='random', n_iter=100, max_time=None):
+        # create the phases
+        n = len(self.bins)
+        k = np.arange(1, n+1)
+
+        if phase == 'random':
+            return 2*np.pi*np.random.rand(n)
+
+        # Schroeder and Newman phases are made for uniform frequency grids
+        # (for a wide logarithmic grid, they give higher crest factors than
+        # random phases)
+        spacing = np.diff(self.bins)
+        if phase in ('schroeder', 'newman') and n > 2 and np.max(spacing) > 2*np.min(spacing):
+            warnings.warn(f"The '{phase}' phases are made for uniformly spaced frequencies, "
+                          "the crest factor of this logarithmic grid may be higher than "
+                          "with 'random' or 'optimized' phases")
+
+        # Schroeder phases (equal amplitudes)
+        f = self.bins.astype(float)
+        schroeder = -2*np.pi*(f*k - np.cumsum(f))/n
+
+        if phase == 'schroeder':
+            return schroeder
+
+        if phase == 'newman':
+            return np.pi*(k-1)**2/n
+
+        if phase == 'optimized':
+            # iterative clipping: the peaks of the signal are clipped and
+            # only the phases of the clipped signal spectrum are kept
+            start = time.perf_counter()
+
+            # starting point: the lowest crest factor of the Schroeder and the
+            # random phases (Schroeder phases are a bad start on a log grid)
+            candidates = [schroeder, 2*np.pi*np.random.rand(n)]
+            phases = min(candidates, key=lambda p: self._crest_factor(self._synthesize(p)))
+            best_phases, best_crest_factor = phases, np.inf
+            for _ in range(n_iter):
+                x = self._synthesize(phases)
+                crest_factor = self._crest_factor(x)
+                if crest_factor < best_crest_factor:
+                    best_phases, best_crest_factor = phases, crest_factor
+
+                if max_time is not None and time.perf_counter() - start > max_time:
+                    break
+
+                x_max = 0.7*np.max(np.abs(x))
+                x = np.clip(x, -x_max, x_max)
+                X = scipy.fft.rfft(x, workers=self.workers)
+                phases = np.angle(X[self.bins]) + np.pi/2
+            return best_phases
+
+        raise ValueError(f"Unknown phase strategy '{phase}'.")
+
+    @staticmethod
+    def _crest_factor(x):
+        return np.max(np.abs(x))/np.sqrt(np.mean(x**2))
+
+    def _synthesize(self, phases):
+        ''' one period (Tp) of the sum of sines with given phases '''
+        n = self.n_period
+        X = np.zeros(n//2 + 1, dtype=complex)
+        # sin(2*pi*f0*t + phase) = real(exp(1j*(2*pi*f0*t + phase - pi/2)))
+        X[self.bins] = n/2*np.exp(1j*(phases - np.pi/2))
+        if n % 2 == 0:
+            X[-1] *= 2  # the Nyquist bin is counted only once by irfft
+        return scipy.fft.irfft(X, n, workers=self.workers)
+
+    @property
+    def n_period(self):
+        ''' number of samples of one period '''
+        return int(np.round(self.Tp*self.fs))
+
+    @property
+    def n_x(self):
+        ''' number of samples used to calculate the spectra (Tx seconds) '''
+        return int(np.round(self.Tx*self.fs))
+
+    @property
+    def period(self):
+        ''' one period (Tp) of the normalized multitone signal (cached)
+
+            The period is synthesized in the frequency domain: the amplitudes
+            and random phases are placed at the FFT bins of the frequencies
+            and one inverse FFT gives the sum of all the sines. '''
+        if getattr(self, '_period_key', None) != self._cache_key():
+            x = self._synthesize(self.random_phase)
+
+            # normalized signal
+            self._period = x / np.max(np.abs(x))
+            self._period.flags.writeable = False
+            self._period_key = self._cache_key()
+        return self._period
+
+    @property
+    def crest_factor(self):
+        ''' crest factor of the signal (peak value / rms value) '''
+        return self._crest_factor(self.period)
 
     @property
     def signal(self):
-        t = np.arange(0, self.T, 1/self.fs)
-        x = np.zeros(int(self.T*self.fs))
-        for f0, random_phase in zip(self.frequencies, self.random_phase):
-            x += np.sin(2*np.pi*f0*t + random_phase)
+        ''' generates the multitone signal (calculated once, then cached) '''
+        if getattr(self, '_signal_key', None) != self._cache_key():
+            self._signal = self._samples(0, int(np.round(self.T*self.fs)))
+            # the array is shared between calls, it must not be modified
+            self._signal.flags.writeable = False
+            self._spectrum = None
+            self._signal_key = self._cache_key()
+        return self._signal
+
+    @property
+    def spectrum(self):
+        ''' spectrum of the last Tx seconds of the signal at the frequencies (cached) '''
+        x = self.signal
+        if self._spectrum is None:
+            x = x[-self.n_x:]
+            Xall = scipy.fft.rfft(x, workers=self.workers)/len(x)*2
+            self._spectrum = Xall[self.n_x//self.n_period*self.bins]
+        return self._spectrum
 
-        # return normalized signal
-        return x / np.max(np.abs(x))
+    def signal_blocks(self, block_size=4096):
+        ''' generator of the multitone signal in blocks of block_size samples '''
+        n_total = int(np.round(self.T*self.fs))
+        for start in range(0, n_total, block_size):
+            yield self._samples(start, min(start + block_size, n_total))
+
+    def _cache_key(self):
+        return (self.T, self.fs, self.Tp, self.bins.tobytes(), self.random_phase.tobytes())
+
+    def _samples(self, start, stop):
+        ''' samples [start, stop) of the normalized multitone signal '''
+        # the signal is periodic, the period is repeated
+        x = self.period
+        return x[np.arange(start, stop) % len(x)]
 
     def extract_spectra(self, y):
 
-        # full output spectra
-        y = y[-self.Tx*self.fs:]
-        Yall = np.fft.rfft(y)/len(y)*2
+        # full output spectra (last Tx seconds, or less if y is shorter,
+        # e.g. one averaged period)
+        n_periods = min(self.n_x, len(y))//self.n_period
+        y = y[-n_periods*self.n_period:]
+        Yall = scipy.fft.rfft(y, workers=self.workers)/len(y)*2
+
+        # input spectra (cached)
+        X = self.spectrum
+        Y = Yall[n_periods*self.bins]
+
+        return Y/X*self._latency_compensation()
+
+    def _latency_compensation(self):
+        ''' removes the phase of the latency at the frequencies '''
+        latency = get_latency(self.fs, self.device) if self.latency is None else self.latency
+        return np.exp(2j*np.pi*self.frequencies*latency/self.fs)
+
+    def averager(self):
+        ''' streaming average of the periods, the first (T-Tx) seconds are skipped '''
+        return PeriodAverager(self.n_period, n_skip=int(np.round(self.T*self.fs)) - self.n_x)
+
+    def analyze_periods(self, y, P=None):
+        ''' Synchronous averaging of the last P periods of the signal y.
+
+            The periods are transformed at once (one FFT of the reshaped signal)
+            and averaged in the frequency domain. The variance across the periods
+            gives the noise level, the averaged spectrum at the non-excited bins
+            gives the distortion.
+
+            Returns a dictionary:
+                'H'          ... averaged spectra relative to the input (as extract_spectra,
+                                 the latency is compensated)
+                'f_axis'     ... frequency axis of all the bins of one period
+                'Y'          ... averaged output spectrum (all the bins)
+                'noise'      ... noise level of the averaged spectrum (all the bins)
+                'excited'    ... mask of the excited bins (self.frequencies)
+                'SNR'        ... signal to noise ratio at the frequencies [dB]
+                'distortion' ... averaged output spectrum at the non-excited bins
+                                 (nan at the excited bins)
+        '''
+        n = self.n_period
+        if P is None:
+            P = self.n_x//n
+        if P*n > np.shape(y)[-1]:
+            raise ValueError("The signal y is shorter than P periods")
+
+        # spectra of all the periods (periods x bins)
+        y = np.asarray(y)[..., -P*n:]
+        y = y.reshape(y.shape[:-1] + (P, n))
+        Ys = scipy.fft.rfft(y, axis=-1, workers=self.workers)/n*2
 
-        # full input spectra
-        x = self.signal[-self.Tx*self.fs:]
-        Xall = np.fft.rfft(x)/len(x)*2
+        # synchronous average and noise of the mean value
+        Y = np.mean(Ys, axis=-2)
+        noise = np.std(Ys, axis=-2, ddof=1)/np.sqrt(P) if P > 1 else np.full(Y.shape, np.nan)
 
-        X = Xall[self.Tx*self.frequencies]
-        Y = Yall[self.Tx*self.frequencies]
+        # excited and non-excited bins
+        f_axis = np.fft.rfftfreq(n, d=1.0/self.fs)
+        bins = self.bins
+        excited = np.zeros(len(f_axis), dtype=bool)
+        excited[bins] = True
+        distortion = np.where(excited, np.nan, Y)
 
-        return Y/X
+        return {'H': Y[..., bins]/self.spectrum*self._latency_compensation(),
+                'f_axis': f_axis,
+                'Y': Y,
+                'noise': noise,
+                'excited': excited,
+                'SNR': 20*np.log10(np.abs(Y[..., bins])/noise[..., bins]),
+                'distortion': distortion}
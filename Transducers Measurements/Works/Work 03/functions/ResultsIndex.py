@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import sqlite3
+import datetime
+import numpy as np
+
+
+class ResultsIndex:
+    """
+    SQLite index of the saved measurement results
+
+    Each saved result (an .npz file) gets one row with its metadata and
+    summary numbers (fs, excitation type, level, Re, fres, THD, setup, ...),
+    so that the results can be selected without opening the files. The index
+    is updated incrementally, every time a result is saved (see save_result).
+
+
+    Usage
+    ----------
+    index = ResultsIndex('results/index.sqlite')
+
+    # save a result and index it at once
+    save_result('results_part_1/coil_07.npz', index, label='coil 07 in motor',
+                excitation='multitone', level=np.std(u), setup='iron',
+                f_axis=f_axis, fs=fs, U=U, I=I)
+
+    # all the coils measured with iron at more than 1 Vrms
+    rows = index.query("setup = ? AND level > ?", ('iron', 1))
+    plot_ReLe(index.files("setup = ? AND level > ?", ('iron', 1)), [0, 10], [0, 2])
+
+
+    Attributes
+    ----------
+    filename : str
+        SQLite database file
+    COLUMNS : dict
+        indexed columns and their SQL types (the other metadata are stored
+        as JSON in the 'metadata' column)
+
+    Methods
+    -------
+    add(path, label=None, **metadata)
+        adds (or replaces) the result saved in path
+    remove(path)
+        removes the result from the index
+    query(where=None, params=(), order_by='id')
+        rows (dicts) matching the SQL condition where
+    files(where=None, params=(), order_by='id')
+        (path, label) tuples, as used by plot_ReLe and plot_current_spec
+
+    """
+
+    COLUMNS = {
+        'path': 'TEXT UNIQUE NOT NULL',
+        'label': 'TEXT',
+        'timestamp': 'TEXT',
+        'fs': 'REAL',
+        'excitation': 'TEXT',
+        'level': 'REAL',
+        'setup': 'TEXT',
+        'Re': 'REAL',
+        'fres': 'REAL',
+        'THD': 'REAL',
+        'metadata': 'TEXT',
+    }
+
+    def __init__(self, filename='results/index.sqlite'):
+        self.filename = filename
+        folder = os.path.dirname(filename)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        columns = ', '.join(f'"{name}" {sql_type}' for name, sql_type in self.COLUMNS.items())
+        with self._connect() as db:
+            db.execute(f'CREATE TABLE IF NOT EXISTS results (id INTEGER PRIMARY KEY, {columns})')
+            for name in ('excitation', 'level', 'setup'):
+                db.execute(f'CREATE INDEX IF NOT EXISTS idx_{name} ON results ("{name}")')
+
+    def _connect(self):
+        db = sqlite3.connect(self.filename)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def add(self, path, label=None, **metadata):
+        ''' adds (or replaces) the result saved in path, the metadata that are
+            not columns of the index are kept as JSON '''
+        row = {'path': os.path.normpath(path), 'label': label,
+               'timestamp': metadata.pop('timestamp', datetime.datetime.now().isoformat())}
+        for name in self.COLUMNS:
+            if name in metadata:
+                row[name] = _to_sql(metadata.pop(name))
+        row['metadata'] = json.dumps(metadata, default=_to_json)
+
+        names = ', '.join(f'"{name}"' for name in row)
+        marks = ', '.join('?'*len(row))
+        with self._connect() as db:
+            db.execute(f'INSERT OR REPLACE INTO results ({names}) VALUES ({marks})',
+                       tuple(row.values()))
+
+    def remove(self, path):
+        with self._connect() as db:
+            db.execute('DELETE FROM results WHERE path = ?', (os.path.normpath(path),))
+
+    def query(self, where=None, params=(), order_by='id'):
+        ''' rows (dicts) matching the SQL condition, e.g.
+            index.query("setup = ? AND level > ?", ('iron', 1)) '''
+        sql = 'SELECT * FROM results'
+        if where:
+            sql += f' WHERE {where}'
+        sql += f' ORDER BY {order_by}'
+        with self._connect() as db:
+            rows = [dict(row) for row in db.execute(sql, tuple(params))]
+        for row in rows:
+            row.update(json.loads(row.pop('metadata') or '{}'))
+        return rows
+
+    def files(self, where=None, params=(), order_by='id'):
+        ''' (path, label) tuples of the matching results '''
+        return [(row['path'], row['label'] or row['path'])
+                for row in self.query(where, params, order_by)]
+
+
+def save_result(filename, index, label=None, excitation=None, level=None, setup=None,
+                metadata={}, **arrays):
+    ''' saves the arrays with np.savez and adds the result to the index
+        (fs, Re and fres are taken from the arrays when possible, the
+        metadata, e.g. a known fres, override them) '''
+    np.savez(filename, **arrays)
+
+    summary = {'excitation': excitation, 'level': level, 'setup': setup}
+    if 'fs' in arrays:
+        summary['fs'] = arrays['fs']
+    if {'f_axis', 'U', 'I'} <= set(arrays):
+        summary.update(impedance_summary(arrays['f_axis'], arrays['U'], arrays['I']))
+    summary.update(metadata)
+    index.add(filename, label=label, **summary)
+
+
+def impedance_summary(f_axis, U, I):
+    ''' Re (at the lowest frequency) and fres (maximum of |Z|) of Z = U/I,
+        fres only if the maximum is a peak inside the band (a blocked coil
+        has its maximum at the highest frequency) '''
+    f_axis = np.asarray(f_axis)
+    Ze = np.asarray(U)/np.asarray(I)
+    valid = (f_axis > 0) & np.isfinite(Ze)
+    f, Ze = f_axis[valid], Ze[valid]
+    if len(f) == 0:
+        return {}
+    summary = {'Re': float(np.real(Ze[np.argmin(f)]))}
+    k = np.argmax(np.abs(Ze))
+    if f[k] != f.min() and f[k] != f.max():
+        summary['fres'] = float(f[k])
+    return summary
+
+
+def thd(f_axis, Y, f0, n_harmonics=10):
+    ''' Total Harmonic Distortion of the spectrum Y for the fundamental f0
+        (harmonics 2 ... n_harmonics, the closest bins) '''
+    f_axis = np.asarray(f_axis)
+    k = [np.argmin(np.abs(f_axis - n*f0)) for n in range(1, n_harmonics + 1)
+         if n*f0 <= f_axis[-1]]
+    A = np.abs(np.asarray(Y)[k])
+    return float(np.sqrt(np.sum(A[1:]**2))/A[0])
+
+
+def _to_sql(value):
+    ''' numpy values stored in the index '''
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return value
+
+
+def _to_json(value):
+    ''' numpy values in the JSON metadata '''
+    if isinstance(value, (np.generic, np.ndarray)):
+        return _to_sql(value)
+    raise TypeError(f"{type(value)} can not be saved in the metadata")
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import scipy.fft
+
+
+class ThieleSmall:
+    """
+    Loudspeaker described by its Thiele-Small parameters (simulated DUT)
+
+    The loudspeaker is driven by the voltage e through a series resistor Rs
+    (the current-sensing resistor of the measurement bench):
+
+        Z(s) = Re + Le*s + Bl**2*s/(Mms*s**2 + Rms*s + Kms)
+        I = E/(Rs + Z),  U = E - Rs*I,  X = Bl*I/(Mms*s**2 + Rms*s + Kms)
+
+    The analog transfer functions are evaluated exactly (s = j*omega) on the
+    bins of a zero-padded FFT, the padding is longer than the decay of the
+    impulse responses (no discretization error, no circular wrap-around).
+
+
+    Usage
+    ----------
+    dut = ThieleSmall(Re=6, Bl=7)
+    u, i, x = dut(e, fs) # voltage [V], current [A] and displacement [m]
+
+
+    Attributes
+    ----------
+    Re, Le : float
+        voice coil resistance [Ohm] and inductance [H]
+    Bl : float
+        force factor [T.m]
+    Mms, Rms, Kms : float
+        moving mass [kg], mechanical resistance [kg/s] and stiffness [N/m]
+    Rs : float
+        series (current-sensing) resistor [Ohm]
+
+    """
+
+    def __init__(self, Re=6.0, Le=0.5e-3, Bl=7.0, Mms=15e-3, Rms=1.5, Kms=1500.0, Rs=1.0):
+        self.Re = Re
+        self.Le = Le
+        self.Bl = Bl
+        self.Mms = Mms
+        self.Rms = Rms
+        self.Kms = Kms
+        self.Rs = Rs
+
+    def __call__(self, e, fs):
+        ''' voltage, current and displacement for the driving voltage e '''
+        e = np.asarray(e, dtype=np.float64)
+        n = e.shape[-1]
+        mech = np.array([self.Mms, self.Rms, self.Kms])
+        # (R + Le*s)*(Mms*s**2 + Rms*s + Kms) + Bl**2*s
+        den = np.polymul([self.Le, self.Rs + self.Re], mech) + [0, 0, self.Bl**2, 0]
+
+        # zero padding of 30 time constants of the slowest pole
+        tau = 1/np.min(-np.roots(den).real)
+        Nfft = scipy.fft.next_fast_len(n + int(np.ceil(30*tau*fs)), real=True)
+        s = 2j*np.pi*scipy.fft.rfftfreq(Nfft, 1/fs)
+        E = scipy.fft.rfft(e, Nfft)/np.polyval(den, s)
+
+        i = scipy.fft.irfft(E*np.polyval(mech, s), Nfft)[:n]
+        x = scipy.fft.irfft(E*self.Bl, Nfft)[:n]
+        u = e - self.Rs*i
+        return np.array([u, i, x])
+
+
+class VirtualDAQ:
+    """
+    Virtual acquisition device emulating the NI USB-4431 (no hardware needed)
+
+    A VirtualDAQ object is called exactly like `measurement_NI`, so that the
+    whole acquisition -> deconvolution -> fit pipeline can be run (and
+    profiled) without the NI device. The output x is sent to the DUT model,
+    whose outputs are delayed by the latency of the device, multiplied by the
+    channel gains (sensor sensitivities, in V per physical unit), corrupted
+    by noise and quantized by the ADC.
+
+
+    Usage
+    ----------
+    # drop-in replacement of measurement_NI
+    from functions.measurement_virtual import measurement_virtual as measurement_NI
+    y = measurement_NI(x, fs, Dev) # 4 channels: AI0 voltage, AI1 current, AI2 displacement
+
+    # or with a custom device and DUT
+    daq = VirtualDAQ(dut=ThieleSmall(Bl=5), latency=63.5, noise=1e-4, seed=1)
+    y = daq(x, fs, 'Dev1')
+
+
+    Attributes
+    ----------
+    dut : callable
+        model of the device under test, dut(x, fs) returns the physical
+        signals of the channels (ThieleSmall() by default: u, i, x)
+    latency : float
+        delay of the inputs relative to the output [samples], can be fractional
+    gains : list of float
+        sensitivities of the channels [V per unit]; the default emulates the
+        bench: 1 V/V, 1 Ohm resistor and a 2 mm/V laser
+    noise : float
+        standard deviation of the (white) input noise [V]
+    n_bits : int
+        resolution of the ADC
+    input_range : float
+        full scale of the inputs [V] (the ADC clips outside +-input_range)
+    output_range : float
+        full scale of the analog output [V]
+    seed : int or None
+        seed of the noise generator
+
+    """
+
+    def __init__(self, dut=None, latency=0, gains=[1.0, 1.0, 1/2e-3, 1.0], noise=1e-5,
+                 n_bits=24, input_range=10.0, output_range=3.5, seed=None):
+        self.dut = ThieleSmall() if dut is None else dut
+        self.latency = latency
+        self.gains = list(gains)
+        self.noise = noise
+        self.n_bits = n_bits
+        self.input_range = input_range
+        self.output_range = output_range
+        self.rng = np.random.default_rng(seed)
+
+    def __call__(self, x, fs, Dev=None, iepe=[False, False, False, False], dtype=np.float64):
+        ''' same signature and output as measurement_NI: plays x and returns
+            the (channels x len(x)) inputs, one channel per `iepe` entry '''
+        x = np.asarray(x, dtype=np.float64)
+        if np.max(np.abs(x), initial=0) > self.output_range:
+            raise ValueError(f"The output exceeds the range of +-{self.output_range} V")
+        n_channels = len(iepe)
+
+        # physical signals of the DUT, converted to volts
+        signals = np.atleast_2d(self.dut(x, fs))[:n_channels]
+        y = np.zeros((n_channels, len(x)))
+        y[:len(signals)] = signals*np.array(self.gains[:len(signals)])[:, None]
+
+        if self.latency != 0:
+            y = self._delay(y)
+
+        y += self.noise*self.rng.standard_normal(y.shape)
+
+        # ADC quantization and clipping
+        q = 2*self.input_range/2**self.n_bits
+        y = np.clip(np.round(y/q)*q, -self.input_range, self.input_range - q)
+
+        return y.astype(dtype)
+
+    def _delay(self, y):
+        ''' (fractional) delay of the inputs by the latency '''
+        n = y.shape[-1]
+        Nfft = scipy.fft.next_fast_len(n + int(np.ceil(self.latency)) + 1, real=True)
+        f = scipy.fft.rfftfreq(Nfft)
+        Y = scipy.fft.rfft(y, Nfft, axis=-1)*np.exp(-2j*np.pi*f*self.latency)
+        return scipy.fft.irfft(Y, Nfft, axis=-1)[..., :n]
+
+
+# default virtual device, drop-in replacement of measurement_NI
+measurement_virtual = VirtualDAQ()
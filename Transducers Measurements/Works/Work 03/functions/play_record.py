@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import threading
+import warnings
+import numpy as np
+
+
+def play_record(x, fs, inputs, outputs=[0], calibration=None, backend='ni',
+                device=None, **options):
+    '''
+    Plays x and records the inputs with any acquisition device.
+
+    The same call works with the National Instruments devices (nidaqmx), the
+    sound cards (sounddevice) and the virtual device (no hardware), and it
+    always returns a calibrated (channels x samples) float array, so that the
+    rest of the processing is written once.
+
+    Args:
+    - x (ndarray): Output signal, 1-D (one output) or (outputs x samples).
+    - fs (float): Sample rate in Hz.
+    - inputs (list of int): Input channels as numbered by the device
+                            (NI: 0 for ai0, sounddevice: 1 for the first input).
+    - outputs (list of int, optional): Output channels (NI: only [0] for ao0,
+                                       sounddevice: 1 for the first output).
+    - calibration (dict, optional): 'output' ... unit of x per device unit (x is divided by it),
+                                    'inputs' ... unit per device unit of each input.
+    - backend (str, optional): 'ni', 'sounddevice' or 'virtual'.
+    - device (optional): Name of the NI device (e.g. 'Dev1') or sounddevice device(s).
+    - options: Passed to the backend (e.g. iepe=[...] for NI, the VirtualDAQ for 'virtual').
+
+    Returns:
+    - ndarray: A 2D array (len(inputs) x samples) of the calibrated inputs.
+
+    Example:
+        y = play_record(x, fs, inputs=[8, 7, 6], outputs=[9], backend='sounddevice',
+                        device=(6, 6), calibration={'inputs': [10/1.014, 10/9.28, 10*25e-3]})
+        u, i, v = y
+    '''
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend '{backend}', use one of {list(BACKENDS)}")
+    calibration = {} if calibration is None else calibration
+
+    x = np.atleast_2d(np.asarray(x, dtype=np.float64))
+    if len(x) != len(outputs):
+        raise ValueError("x must have one row per output channel")
+    x = x/calibration.get('output', 1.0)
+
+    y = BACKENDS[backend](x, fs, list(inputs), list(outputs), device, **options)
+
+    sensitivities = np.broadcast_to(calibration.get('inputs', 1.0), (len(inputs),))
+    return y*np.asarray(sensitivities, dtype=np.float64)[:, None]
+
+
+def _play_record_ni(x, fs, inputs, outputs, device, iepe=None):
+    ''' NI device through a (one-shot) MeasurementSession '''
+    from .measurement_NI import MeasurementSession
+
+    if outputs != [0]:
+        raise ValueError("The NI backend plays on ao0 only (outputs=[0])")
+    if iepe is None:
+        iepe = [False]*(max(inputs) + 1)
+    with MeasurementSession(fs, device, iepe=iepe) as session:
+        y = session.measure(x[0])
+    return y[inputs]
+
+
+def _play_record_virtual(x, fs, inputs, outputs, device, daq=None):
+    ''' virtual device (VirtualDAQ), no hardware needed '''
+    from .measurement_virtual import measurement_virtual
+
+    if outputs != [0]:
+        raise ValueError("The virtual backend plays on ao0 only (outputs=[0])")
+    daq = measurement_virtual if daq is None else daq
+    y = daq(x[0], fs, device, iepe=[False]*(max(inputs) + 1))
+    return y[inputs]
+
+
+def _play_record_sounddevice(x, fs, inputs, outputs, device, blocksize=0):
+    ''' sound card, callback-based full-duplex stream (sounddevice) '''
+    import sounddevice as sd
+
+    n_samples = x.shape[-1]
+    # the channels are numbered from 1, the stream opens all of them up to the last one
+    idx_in = np.array(inputs) - 1
+    idx_out = np.array(outputs) - 1
+    y = np.zeros((len(inputs), n_samples))
+    position = 0
+    status_flags = []
+    done = threading.Event()
+
+    def callback(indata, outdata, frames, time, status):
+        nonlocal position
+        if status:
+            status_flags.append(status)
+        n = min(frames, n_samples - position)
+
+        outdata.fill(0)
+        outdata[:n, idx_out] = x[:, position:position + n].T
+        y[:, position:position + n] = indata[:n, idx_in].T
+
+        position += n
+        if position >= n_samples:
+            raise sd.CallbackStop
+
+    stream = sd.Stream(samplerate=fs, blocksize=blocksize, device=device,
+                       channels=(max(inputs), max(outputs)), dtype='float32',
+                       callback=callback, finished_callback=done.set)
+    with stream:
+        done.wait()
+
+    if status_flags:
+        warnings.warn(f"sounddevice reported {len(status_flags)} problem(s): {status_flags[0]}")
+    return y
+
+
+# available backends of play_record
+BACKENDS = {
+    'ni': _play_record_ni,
+    'sounddevice': _play_record_sounddevice,
+    'virtual': _play_record_virtual,
+}
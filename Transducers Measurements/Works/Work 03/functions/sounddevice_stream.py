@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+import warnings
+import numpy as np
+
+
+class RingBuffer:
+    """
+    Single-producer single-consumer ring buffer of frames
+
+    The producer only moves the write counter and the consumer only moves the
+    read counter, each of them after the copy of the frames, so that no lock
+    is needed between the audio callback and the writer thread.
+
+
+    Usage
+    ----------
+    ring = RingBuffer(n_frames=96000, n_channels=2)
+    n = ring.write(frames)      # producer, frames is (n x channels)
+    n = ring.read(out)          # consumer, fills out (n x channels)
+
+
+    Attributes
+    ----------
+    n_frames : int
+        capacity of the buffer [frames]
+    available : int
+        number of frames that can be read
+    free : int
+        number of frames that can be written
+
+    """
+
+    def __init__(self, n_frames, n_channels, dtype=np.float32):
+        self.n_frames = int(n_frames)
+        self.data = np.zeros((self.n_frames, n_channels), dtype=dtype)
+        self._written = 0   # frames written so far (producer only)
+        self._read = 0      # frames read so far (consumer only)
+
+    @property
+    def available(self):
+        return self._written - self._read
+
+    @property
+    def free(self):
+        return self.n_frames - self.available
+
+    def write(self, frames):
+        ''' writes as many frames as possible, returns their number '''
+        n = min(len(frames), self.free)
+        start = self._written % self.n_frames
+        k = min(n, self.n_frames - start)
+        self.data[start:start + k] = frames[:k]
+        self.data[:n - k] = frames[k:n]
+        self._written += n
+        return n
+
+    def read(self, out):
+        ''' reads as many frames as possible into out, returns their number '''
+        n = min(len(out), self.available)
+        start = self._read % self.n_frames
+        k = min(n, self.n_frames - start)
+        out[:k] = self.data[start:start + k]
+        out[k:n] = self.data[:n - k]
+        self._read += n
+        return n
+
+
+class SoundDeviceStream:
+    """
+    Full-duplex sound card streaming from a generator to a file
+
+    For measurements that do not fit in memory (long sweeps, high sample
+    rates): the output blocks are pulled from a generator and the recorded
+    frames are appended to a binary file. The audio callback only copies
+    frames from and to two ring buffers, a writer thread fills the output
+    ring from the generator and drains the input ring to the disk. The
+    memory use does not depend on the duration of the measurement.
+
+    The xruns are counted: the ones reported by the sound card (input
+    overflow, output underflow) and the ones of the ring buffers (generator
+    or disk too slow).
+
+
+    Usage
+    ----------
+    stream = SoundDeviceStream(fs, inputs=[1, 2], outputs=[1], device=(6, 6))
+    n = stream.run(sss.signal_blocks(), 'sweep.bin')
+    print(stream.xruns)
+
+    # recorded (channels x samples) signal, read from the disk on demand
+    y = np.memmap('sweep.bin', dtype=np.float32, mode='r').reshape(-1, 2).T
+
+
+    Attributes
+    ----------
+    fs : float
+        sample rate
+    inputs, outputs : list of int
+        channels of the sound card (numbered from 1)
+    device : int, str or tuple
+        sounddevice device(s)
+    blocksize : int
+        frames per callback
+    buffer_size : int
+        capacity of the ring buffers [frames] (2 seconds by default)
+    tail : int
+        frames of silence recorded after the end of the generator, so that
+        the response delayed by the latency is not cut (fs/2 by default)
+    xruns : dict
+        number of 'input_overflow', 'output_underflow' (sound card),
+        'ring_overflow' and 'ring_underflow' (writer thread) events
+
+    Methods
+    -------
+    run(blocks, filename)
+        plays the blocks and appends the recording to filename (samples x
+        channels, float32), followed by tail frames, returns the number of
+        recorded frames
+
+    """
+
+    def __init__(self, fs, inputs, outputs=[1], device=None, blocksize=1024, buffer_size=None,
+                 tail=None):
+        self.fs = fs
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.device = device
+        self.blocksize = int(blocksize)
+        self.buffer_size = int(2*fs) if buffer_size is None else int(buffer_size)
+        self.tail = int(fs)//2 if tail is None else int(tail)
+        self.xruns = {}
+
+    def run(self, blocks, filename):
+        ''' plays the blocks and appends the recorded frames to filename '''
+        import sounddevice as sd
+
+        n_in, n_out = len(self.inputs), len(self.outputs)
+        idx_in = np.array(self.inputs) - 1
+        idx_out = np.array(self.outputs) - 1
+        out_ring = RingBuffer(self.buffer_size, n_out)
+        in_ring = RingBuffer(self.buffer_size, n_in)
+        blocks = iter(blocks)
+
+        self.xruns = dict.fromkeys(
+            ['input_overflow', 'output_underflow', 'ring_overflow', 'ring_underflow'], 0)
+        # scratch buffers of the callback (no allocation while streaming)
+        out_frames = np.zeros((self.blocksize, n_out), dtype=np.float32)
+        in_frames = np.zeros((self.blocksize, n_in), dtype=np.float32)
+        feeder = _Feeder(blocks, n_out)
+        state = {'n_recorded': 0, 'n_written': 0, 'error': None}
+        finished = threading.Event()
+
+        def callback(indata, outdata, frames, time_info, status):
+            if status.input_overflow:
+                self.xruns['input_overflow'] += 1
+            if status.output_underflow:
+                self.xruns['output_underflow'] += 1
+
+            # output: zeros after the end of the signal or if the generator is late
+            n = out_ring.read(out_frames[:frames])
+            outdata.fill(0)
+            outdata[:n, idx_out] = out_frames[:n]
+            if n < frames and not feeder.exhausted:
+                self.xruns['ring_underflow'] += 1
+
+            np.take(indata, idx_in, axis=1, out=in_frames[:frames])
+            if in_ring.write(in_frames[:frames]) < frames:
+                self.xruns['ring_overflow'] += 1
+            state['n_recorded'] += frames
+
+            # the recording stops tail frames after the end of the signal
+            if feeder.exhausted and state['n_recorded'] >= feeder.n_frames + self.tail:
+                raise sd.CallbackStop
+
+        def writer():
+            # fills the output ring and drains the input ring to the disk
+            try:
+                chunk = np.zeros((self.blocksize, n_in), dtype=np.float32)
+                with open(filename, 'ab') as file:
+                    while not finished.is_set() or in_ring.available > 0:
+                        busy = feeder.fill(out_ring)
+
+                        n = in_ring.read(chunk)
+                        if feeder.exhausted:
+                            n = min(n, feeder.n_frames + self.tail - state['n_written'])
+                        file.write(chunk[:n].tobytes())
+                        state['n_written'] += n
+
+                        if not busy and n == 0:
+                            time.sleep(self.blocksize/self.fs/4)
+            except Exception as e:
+                state['error'] = e
+                finished.set()
+
+        # the output ring is filled before the stream starts
+        feeder.fill(out_ring)
+
+        thread = threading.Thread(target=writer)
+        thread.start()
+        try:
+            stream = sd.Stream(samplerate=self.fs, blocksize=self.blocksize,
+                               device=self.device,
+                               channels=(max(self.inputs), max(self.outputs)),
+                               dtype='float32', callback=callback,
+                               finished_callback=finished.set)
+            with stream:
+                finished.wait()
+        finally:
+            finished.set()
+            thread.join()
+
+        if state['error'] is not None:
+            raise state['error']
+        if any(self.xruns.values()):
+            warnings.warn(f"xruns during the measurement: {self.xruns}")
+        return state['n_written']
+
+
+class _Feeder:
+    ''' moves the blocks of a generator (any length, 1-D or outputs x samples)
+        into a ring buffer of frames '''
+
+    def __init__(self, blocks, n_channels):
+        self.blocks = blocks
+        self.n_channels = n_channels
+        self.pending = np.zeros((0, n_channels), dtype=np.float32)
+        self.n_frames = 0
+        self.exhausted = False
+
+    def fill(self, ring):
+        ''' writes frames until the ring is full, returns True if any was written '''
+        busy = False
+        while not self.exhausted and ring.free > 0:
+            if len(self.pending) == 0:
+                x = next(self.blocks, None)
+                if x is None:
+                    self.exhausted = True
+                    break
+                x = np.asarray(x, dtype=np.float32)
+                self.pending = x.reshape(self.n_channels, -1).T
+            n = ring.write(self.pending)
+            self.pending = self.pending[n:]
+            self.n_frames += n
+            busy = busy or n > 0
+        return busy
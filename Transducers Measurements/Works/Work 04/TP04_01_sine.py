@@ -19,7 +19,7 @@ out_signal =                        # Generate the sine signal
 y = measurement_NI(out_signal, fs, Dev, iepe=[True])
 
 # Extract signals from measured data (voltage)
-u = np.array(y)
+u = y[0]
 
 
 """ SAVE  """
@@ -32,7 +32,7 @@ out_signal /= norm_amplitude
 y = measurement_NI(out_signal, fs, Dev, iepe=[True])
 
 # Extract signals from measured data (voltage)
-u = np.array(y)
+u = y[0]
 
 
 
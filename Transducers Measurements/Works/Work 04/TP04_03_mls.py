@@ -46,7 +46,7 @@ out_signal = np.concatenate((one_second_signal, np.tile(x, N_periods)))
 y = measurement_NI(out_signal, fs, Dev, iepe=[True])
 
 # Extract signals from measured data (voltage)
-u = np.array(y)
+u = y[0]
 
 """ SAVE  """
 np.savez(filename, u=u, x=x, N_bits=N_bits, L_sequence=L_sequence,
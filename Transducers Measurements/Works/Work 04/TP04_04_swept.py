@@ -22,7 +22,7 @@ out_signal = np.concatenate((sss.signal, np.zeros(int(0.5*fs))))
 y = measurement_NI(out_signal, fs, Dev, iepe=[True])
 
 # Extract signals from measured data (voltage)
-u = np.array(y)
+u = y[0]
 
 
 """ SAVE  """
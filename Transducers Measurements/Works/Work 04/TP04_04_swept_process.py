@@ -1,6 +1,9 @@
 import numpy as np
 import matplotlib.pyplot as plt
 from functions.SynchSweptSine import SynchSweptSine
+from functions.ProcessingCache import ProcessingCache
+from functions.latency import load_latencies, get_latency
+from TP04_00_parameters import Dev
 
 
 """ Load the measurement data """
@@ -14,9 +17,10 @@ with np.load('results_part_4/swept.npz') as data:
 
 
 """ Parameters for nonlinear sepearation """
-sss = SynchSweptSine(f1=f1, f2=f2, T=T, fs=fs)
 len_IR = 2**13              # length of the extracted impulse responses
 N = 3                       # number of higher harmonics to be extracted
+load_latencies()            # latencies saved in latencies.json by measure_latency
+latency = get_latency(fs, device=Dev)   # latency of the measurement [samples]
 
 
 """ Convert the measured voltage to pressure using microphone sensitivity """
@@ -24,8 +28,18 @@ p = u
 
 
 """ Extract spectra from swept-sine  """
-h = sss.getIR(p)                                # the full impulse response
-Hs = sss.separate_IR(h, N, n_samples=len_IR)    # separatef HHFRs
+def extract(p, f1, f2, T, fs, N, n_samples, latency):
+    # everything is calculated from the arguments (the key of the cache)
+    sss = SynchSweptSine(f1=f1, f2=f2, T=T, fs=fs)
+    h = sss.getIR(p)                                                # the full impulse response
+    Hs = sss.separate_IR(h, N, n_samples=n_samples, latency=latency)  # separatef HHFRs
+    return h, Hs
+
+
+# computed once, then loaded from the cache (until p or a parameter changes)
+cache = ProcessingCache('cache')
+h, Hs = cache('swept', extract, p, f1=f1, f2=f2, T=T, fs=fs,
+              N=N, n_samples=len_IR, latency=latency)
 f_axis = np.fft.rfftfreq(len_IR, 1/fs)
 
 
@@ -0,0 +1,266 @@
+import numpy as np
+import scipy.fft
+from scipy.signal import max_len_seq
+from .PeriodAverager import PeriodAverager
+from .latency import get_latency
+
+
+class MLS:
+    """
+    Maximum Length Sequence (MLS)
+
+    The MLS is a pseudo-random binary sequence of length L = 2**N_bits - 1
+    whose circular autocorrelation is (almost) a Dirac. The impulse response
+    of a linear system is thus obtained by a circular cross-correlation of the
+    recorded signal with the sequence. The cross-correlation is calculated
+    with the Fast Hadamard Transform (FHT): it uses only additions and
+    subtractions, it is O(L log L) and it works in place (no complex FFT
+    buffers, N_bits up to 24 fits easily in memory).
+
+    With irs=True the Inverse Repeated Sequence (IRS) is played instead: every
+    other sample of the MLS is inverted, which gives a period of 2L samples
+    whose second half is the negation of the first one. The even-order
+    products of the DUT are the same for both halves and cancel in the
+    deconvolution, the IR is free of the even-order distortion spikes for the
+    same measurement time. (Dunn and Hawksford, "Distortion immunity of
+    MLS-derived impulse response measurements", JAES 41.5 (1993): 314-335)
+
+
+    Usage
+    ----------
+    mls = MLS(N_bits=18, fs=fs, N_periods=4) # !!! mls is an object
+    x = mls.signal # one second pre-roll followed by N_periods of the MLS
+
+    #                              -------
+    # then do the measurement x -> | DUT | -> y
+    #                              -------
+
+    h = mls.getIR(y) # impulse response (the periods are averaged)
+    H = mls.getFRF(y, N_samples=2**13) # FRF of the truncated impulse response
+
+    # or average the periods while the signal is being acquired
+    avg = mls.averager()
+    for y_block in blocks:
+        avg.process(y_block)
+    h = mls.deconvolve(avg.mean)
+
+    # inverse repeated sequence (cancels the even-order distortion)
+    irs = MLS(N_bits=17, fs=fs, N_periods=2, irs=True)
+
+
+    Attributes
+    ----------
+    N_bits : int
+        number of bits of the shift register (order of the MLS)
+    L_sequence : int
+        length of the sequence (2**N_bits - 1)
+    fs : int
+        sample rate
+    N_periods : int
+        number of periods of the MLS in the signal
+    irs : bool
+        Inverse Repeated Sequence mode (default False)
+    n_period : int
+        number of samples of one period of the signal
+        (L_sequence, or 2*L_sequence in the IRS mode)
+    n_pre : int
+        number of samples of the pre-roll (end of the sequence played before
+        the periods, to get the DUT into a steady state), fs by default
+    sequence : numpy array
+        binary MLS sequence (0s and 1s)
+    x : numpy array
+        bipolar MLS sequence (-1s and 1s)
+    signal : numpy array
+        pre-roll followed by N_periods of the bipolar sequence, or of the IRS
+        (cached, read-only)
+    workers : int or None
+        number of workers used by scipy.fft (-1 ... all CPU cores)
+    latency : float or None
+        latency of the measurement in samples, the IR is circularly shifted
+        by its integer part and getFRF compensates the sub-sample part
+        (if None the latency of device at fs set in this session is used,
+        see functions.latency)
+    device : str, tuple or None
+        acquisition device the latency is looked up for
+
+    Methods
+    -------
+    getIR(y)
+        get the impulse response (L_sequence samples) from the recorded signal y
+        (y can be 1-D or 2-D with channels along the first axis)
+    getFRF(y, N_samples=None)
+        get the FRF from the impulse response truncated to N_samples
+        (if not provided fs number of samples is taken)
+    deconvolve(y_period)
+        get the impulse response from one (averaged) period of the recorded signal
+    averager()
+        creates a PeriodAverager for the streaming average of the periods
+    f_axis(Npts)
+        frequency axis of the FRF of Npts samples impulse response
+
+    """
+
+    def __init__(self, N_bits=18, fs=48000, N_periods=1, n_pre=None, workers=None, irs=False,
+                 latency=None, device=None):
+        self.N_bits = N_bits
+        self.L_sequence = 2**N_bits - 1
+        self.fs = fs
+        self.N_periods = N_periods
+        self.irs = irs
+        self.n_period = 2*self.L_sequence if irs else self.L_sequence
+        self.n_pre = int(fs) if n_pre is None else int(n_pre)
+        self.workers = workers
+        self.latency = latency
+        self.device = device
+
+        # binary sequence and bipolar signal
+        self.sequence = max_len_seq(nbits=N_bits)[0]
+        self.x = 2*self.sequence.astype(np.int8) - 1
+
+        # permutations between the sequence and the Hadamard matrix
+        self._idx_in, self._idx_out = self._permutations()
+
+    @property
+    def signal(self):
+        ''' pre-roll followed by N_periods of the MLS (calculated once, then cached) '''
+        if getattr(self, '_signal', None) is None:
+            # the pre-roll is the end of the (periodic) sequence
+            n = np.arange(-self.n_pre, self.N_periods*self.n_period) % self.n_period
+            self._signal = self.x[n % self.L_sequence].astype(float)
+            if self.irs:
+                # every other sample inverted (L is odd, so x[n+L] = -x[n])
+                self._signal[n % 2 == 1] *= -1
+            # the array is shared between calls, it must not be modified
+            self._signal.flags.writeable = False
+        return self._signal
+
+    def f_axis(self, Npts):
+        return np.fft.rfftfreq(Npts, d=1.0/self.fs)
+
+    def getIR(self, y):
+        ''' calculates the impulse response from the measured signal y
+            (the pre-roll is removed and the periods are averaged) '''
+        P = self.n_period
+        y = np.asarray(y)
+        y = y[..., self.n_pre:self.n_pre + self.N_periods*P]
+        if y.shape[-1] != self.N_periods*P:
+            raise ValueError("The signal y is shorter than the MLS signal")
+
+        # sum of the periods (integers stay integers, the FHT is then exact)
+        dtype = np.int64 if np.issubdtype(y.dtype, np.integer) else float
+        y = np.sum(y.reshape(y.shape[:-1] + (self.N_periods, P)), axis=-2, dtype=dtype)
+
+        return self.deconvolve(y)/self.N_periods
+
+    def deconvolve(self, y_period):
+        ''' calculates the impulse response from one period of the measured signal
+            (e.g. the averaged period of a PeriodAverager) '''
+        L = self.L_sequence
+        y = np.asarray(y_period)
+        dtype = np.int64 if np.issubdtype(y.dtype, np.integer) else float
+        if y.shape[-1] != self.n_period:
+            raise ValueError("The period must have %d samples" % self.n_period)
+
+        if self.irs:
+            # the even-order products repeat every L samples and cancel in
+            # the difference of the halves, the rest changes sign after L
+            # samples; inverting every other sample makes it L-periodic again
+            # (L is odd), it is then the response of a DUT with the IR
+            # h[n]*(-1)**n to the plain MLS
+            y = (y[..., :L] - y[..., L:])*self._alternate
+            h = self._correlate(y, dtype)*self._alternate/2
+        else:
+            h = self._correlate(y, dtype)
+
+        # the IR is periodic, the latency is removed by a circular shift
+        shift = int(np.round(self._get_latency()))
+        return np.roll(h, -shift, axis=-1) if shift else h
+
+    def _get_latency(self):
+        ''' latency attribute, or the latency of device at fs if it is None '''
+        return get_latency(self.fs, self.device) if self.latency is None else self.latency
+
+    @property
+    def _alternate(self):
+        ''' (-1)**n over one sequence length '''
+        if getattr(self, '_alt', None) is None:
+            self._alt = np.ones(self.L_sequence, dtype=np.int8)
+            self._alt[1::2] = -1
+        return self._alt
+
+    def _correlate(self, y, dtype):
+        ''' circular cross-correlation of y with the sequence, normalized '''
+        L = self.L_sequence
+        # circular cross-correlation with the sequence by FHT
+        z = np.zeros(y.shape[:-1] + (L + 1,), dtype=dtype)
+        z[..., self._idx_in] = y
+        _fht(z)
+        R = -z[..., self._idx_out]
+
+        # the MLS autocorrelation is L+1 at zero lag and -1 elsewhere
+        # (the sum of the IR is equal to the sum of the cross-correlation)
+        return (R + np.sum(R, axis=-1, keepdims=True))/(L + 1)
+
+    def averager(self):
+        ''' streaming average of the periods (the pre-roll is skipped) '''
+        return PeriodAverager(self.n_period, n_skip=self.n_pre)
+
+    def getFRF(self, y, N_samples=None):
+        ''' Calculates the Frequency Response Function of the impulse
+            response truncated to N_samples '''
+        if N_samples == None:
+            N_samples = self.fs
+        h = self.getIR(y)
+        H = scipy.fft.rfft(h[..., :int(N_samples)], axis=-1, workers=self.workers)
+
+        # sub-sample part of the latency (the integer part is removed from h)
+        latency = self._get_latency()
+        frac = latency - np.round(latency)
+        if frac:
+            H *= np.exp(1j*np.fft.rfftfreq(int(N_samples), d=1.0/(2*np.pi))*frac)
+        return H
+
+    def _permutations(self):
+        ''' Permutations of the samples to and from the Hadamard order.
+
+            The MLS obeys a linear recurrence, so any sample a[i+j] is a linear
+            (modulo 2) function of the state s_j = (a[j], ..., a[j+N_bits-1]):
+            a[i+j] = <c_i, s_j>. The MLS matrix (-1)**a[i+j] is then the
+            Hadamard matrix (-1)**<c_i, s_j> with permuted rows and columns.
+            (Cohn and Lempel, "On fast M-sequence transforms",
+            IEEE Trans. Inf. Theory 23.1 (1977): 135-137) '''
+        L = self.L_sequence
+        # the sequence twice, a2[j:j+L] is the sequence shifted by j
+        a2 = np.tile(self.sequence.astype(np.int32), 2)
+
+        # states s_j as integers (N_bits consecutive samples)
+        state = np.zeros(L, dtype=np.int32)
+        for k in range(self.N_bits):
+            state += a2[k:k+L] << k
+
+        # s_j takes all non-zero values once, the unit vectors give c_i
+        j_of_state = np.empty(L + 1, dtype=np.int64)
+        j_of_state[state] = np.arange(L)
+        c = np.zeros(L, dtype=np.int32)
+        for k in range(self.N_bits):
+            j = j_of_state[1 << k]
+            c += a2[j:j+L] << k
+
+        # R[i] = sum_m y[m] x[m-i] needs the row c[-i]
+        return state, np.roll(c[::-1], 1)
+
+
+def _fht(z):
+    ''' in-place Fast (Walsh-)Hadamard Transform along the last axis
+        (natural order, only additions and subtractions) '''
+    n = z.shape[-1]
+    h = 1
+    while h < n:
+        z3 = z.reshape(z.shape[:-1] + (n//(2*h), 2, h))
+        a = z3[..., 0, :]
+        b = z3[..., 1, :]
+        np.subtract(a, b, out=b)    # a - b
+        a += a
+        a -= b                      # 2a - (a - b) = a + b
+        h *= 2
+    return z
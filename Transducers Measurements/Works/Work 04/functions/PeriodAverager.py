@@ -0,0 +1,106 @@
+import numpy as np
+
+
+class PeriodAverager:
+    """
+    Streaming average of a periodic signal (MLS, multitone)
+
+    The recorded samples are added block by block while the acquisition is
+    still running. Each complete period is folded into the running mean, so
+    that the memory stays at a single period whatever the number of averaged
+    periods. The deviation of each new period from the mean of the previous
+    ones is stored, it reveals time-variance or noise bursts.
+
+
+    Usage
+    ----------
+    avg = PeriodAverager(n_period=mls.L_sequence, n_skip=mls.n_pre)
+    # or simply avg = mls.averager()
+
+    for y_block in blocks: # blocks of samples as they arrive
+        avg.process(y_block)
+
+    y_mean = avg.mean                   # averaged period
+    print(avg.period_variance)          # deviation of each period [-]
+    h = mls.deconvolve(y_mean)          # impulse response of the averaged period
+
+
+    Attributes
+    ----------
+    n_period : int
+        number of samples of one period
+    n_skip : int
+        number of samples skipped at the beginning (steady state)
+    n_periods : int
+        number of periods averaged so far
+    mean : numpy array
+        averaged period (n_period samples, or channels x n_period)
+    variance : numpy array
+        variance of each sample of the period across the periods
+    period_variance : list
+        mean square deviation of each period from the average of the
+        previous periods (nan for the first period)
+
+    Methods
+    -------
+    process(y)
+        adds the new samples y (1-D or channels x samples)
+
+    """
+
+    def __init__(self, n_period, n_skip=0):
+        self.n_period = int(n_period)
+        self.n_skip = int(n_skip)
+        self.n_periods = 0
+        self.mean = None
+        self.period_variance = []
+
+        self._to_skip = self.n_skip
+        self._pos = 0
+        self._current = None
+        self._M2 = None
+
+    @property
+    def variance(self):
+        ''' variance of each sample of the period across the periods '''
+        if self.n_periods < 2:
+            return None
+        return self._M2/(self.n_periods - 1)
+
+    def process(self, y):
+        ''' adds the new samples y (the last axis is the time axis) '''
+        y = np.asarray(y)
+
+        # samples skipped at the beginning
+        if self._to_skip > 0:
+            n = min(self._to_skip, y.shape[-1])
+            self._to_skip -= n
+            y = y[..., n:]
+
+        if self._current is None:
+            self._current = np.zeros(y.shape[:-1] + (self.n_period,))
+
+        # fill the current period, fold it once it is complete
+        while y.shape[-1] > 0:
+            n = min(self.n_period - self._pos, y.shape[-1])
+            self._current[..., self._pos:self._pos + n] = y[..., :n]
+            self._pos += n
+            y = y[..., n:]
+            if self._pos == self.n_period:
+                self._fold()
+                self._pos = 0
+
+    def _fold(self):
+        ''' running mean and variance (Welford's algorithm) '''
+        x = self._current
+        self.n_periods += 1
+        if self.mean is None:
+            self.mean = x.copy()
+            self._M2 = np.zeros(x.shape)
+            self.period_variance.append(np.full(x.shape[:-1], np.nan)[()])
+            return
+
+        delta = x - self.mean
+        self.period_variance.append(np.mean(delta**2, axis=-1)[()])
+        self.mean += delta/self.n_periods
+        self._M2 += delta*(x - self.mean)
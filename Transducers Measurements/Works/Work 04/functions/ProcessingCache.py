@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import hashlib
+import numpy as np
+
+
+class ProcessingCache:
+    """
+    Content-addressed cache of processing results (spectra, IRs, HHFRs)
+
+    A result is stored on the disk under a hash of the raw input arrays, of
+    the processing function (module and name), of its version and of the
+    processing parameters. Running the same processing on the same data
+    again only loads the stored result; any change of the data, of a
+    parameter or of the version gives a new key (the code of the function
+    is not hashed, increase its version when it changes). The least
+    recently used results are removed when the cache is larger than
+    max_size.
+
+
+    Usage
+    ----------
+    cache = ProcessingCache('cache', max_size=2**30)
+
+    def process(p, N, n_samples, latency):
+        h = sss.getIR(p)
+        return h, sss.separate_IR(h, N, n_samples=n_samples, latency=latency)
+
+    # computed once, then loaded from the cache (version=2 after a change of process)
+    h, Hs = cache('swept', process, p, N=3, n_samples=2**13, latency=0, version=2)
+
+
+    Attributes
+    ----------
+    folder : str
+        folder of the cached results (.npz files)
+    max_size : int
+        maximum size of the cache [bytes]
+
+    Methods
+    -------
+    __call__(name, function, *arrays, version=0, **params)
+        result of function(*arrays, **params), from the cache if possible
+    key(name, function, *arrays, version=0, **params)
+        hash of the function, its version, the arrays and the parameters
+    get(key)
+        cached result (None if it is not in the cache)
+    put(key, result)
+        stores the result (array, tuple of arrays or dict of arrays, no
+        object arrays: TypeError)
+    clear()
+        removes all the cached results
+
+    """
+
+    def __init__(self, folder='cache', max_size=2**30):
+        self.folder = folder
+        self.max_size = int(max_size)
+        os.makedirs(folder, exist_ok=True)
+
+    def __call__(self, name, function, *arrays, version=0, **params):
+        ''' result of function(*arrays, **params), computed only if it is not cached '''
+        key = self.key(name, function, *arrays, version=version, **params)
+        result = self.get(key)
+        if result is None:
+            result = function(*arrays, **params)
+            self.put(key, result)
+        return result
+
+    def key(self, name, function, *arrays, version=0, **params):
+        ''' hash of the name, the function (module, name and version), the arrays
+            (content, dtype and shape) and the parameters '''
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(name.encode())
+        digest.update(f'{function.__module__}.{function.__qualname__}:{version}'.encode())
+        for a in arrays:
+            a = np.ascontiguousarray(a)
+            digest.update(f'{a.dtype.str}{a.shape}'.encode())
+            digest.update(a.view(np.uint8).data if a.size else b'')
+        digest.update(json.dumps(params, sort_keys=True, default=_to_json).encode())
+        return digest.hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.folder, f'{key}.npz')
+
+    def get(self, key):
+        ''' cached result, or None '''
+        filename = self._filename(key)
+        try:
+            with np.load(filename) as data:
+                kind = str(data['__kind__'])
+                items = {k: data[k] for k in data.files if k != '__kind__'}
+        except FileNotFoundError:
+            return None
+
+        # the access time is kept for the eviction (least recently used)
+        os.utime(filename)
+        if kind == 'array':
+            return items['_0']
+        if kind == 'tuple':
+            return tuple(items[f'_{k}'] for k in range(len(items)))
+        return items
+
+    def put(self, key, result):
+        ''' stores the result, then removes the oldest results if needed '''
+        if isinstance(result, dict):
+            kind, items = 'dict', result
+        elif isinstance(result, tuple):
+            kind, items = 'tuple', {f'_{k}': r for k, r in enumerate(result)}
+        else:
+            kind, items = 'array', {'_0': result}
+
+        # object arrays (None, lists of different lengths, ...) need pickle to be loaded
+        items = {k: np.asarray(v) for k, v in items.items()}
+        for k, v in items.items():
+            if v.dtype.hasobject:
+                raise TypeError(f"The result '{k}' is not a numeric or string array, "
+                                "it can not be cached")
+
+        # written under a temporary name, the cache never holds a partial file
+        filename = self._filename(key)
+        with open(filename + '.tmp', 'wb') as file:
+            np.savez(file, __kind__=kind, **items)
+        os.replace(filename + '.tmp', filename)
+        self._evict()
+
+    def clear(self):
+        for name in os.listdir(self.folder):
+            if name.endswith('.npz'):
+                os.remove(os.path.join(self.folder, name))
+
+    def _evict(self):
+        ''' removes the least recently used results above max_size '''
+        entries = []
+        for name in os.listdir(self.folder):
+            if name.endswith('.npz'):
+                stat = os.stat(os.path.join(self.folder, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        size = sum(entry[1] for entry in entries)
+        for mtime, file_size, name in sorted(entries):
+            if size <= self.max_size:
+                break
+            os.remove(os.path.join(self.folder, name))
+            size -= file_size
+
+
+def _to_json(value):
+    ''' numpy values in the parameters '''
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f"{type(value)} can not be used as a parameter of the cache")
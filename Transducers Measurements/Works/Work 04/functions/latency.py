@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import numpy as np
+import scipy.fft
+
+
+# file where the measured latencies are kept between the sessions (the
+# processing scripts do not run in the process of the measurement)
+LATENCY_FILE = 'latencies.json'
+
+# latencies measured (or loaded) in this session [samples], keyed by (device, fs)
+_LATENCIES = {}
+
+
+def estimate_latency(x, y, max_latency=None, workers=None):
+    '''
+    Latency of the recorded signal y relative to the played signal x.
+
+    The cross-correlation is calculated by FFT, its peak gives the integer
+    latency. The sub-sample part is the slope of the phase of the
+    cross-spectrum once the integer latency is removed (weighted least
+    squares, the phase stays within +-pi/2). y should be a loopback or a
+    reference channel (e.g. the voltage at the DUT terminals), a polarity
+    inversion is allowed.
+
+    Args:
+    - x (ndarray): Played signal.
+    - y (ndarray): Recorded signal (same sample rate).
+    - max_latency (int, optional): Largest latency searched [samples] (len(y) by default).
+    - workers (int, optional): Number of workers used by scipy.fft.
+
+    Returns:
+    - float: Latency [samples].
+
+    Example:
+        latency = estimate_latency(x, y[0])
+        u = y[0, int(round(latency)):]
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    max_latency = len(y) - 1 if max_latency is None else min(int(max_latency), len(y) - 1)
+
+    # cross-correlation (only the positive lags are searched, the system is causal)
+    Nfft = scipy.fft.next_fast_len(len(x) + len(y) - 1, real=True)
+    X = scipy.fft.rfft(x, Nfft, workers=workers)
+    Y = scipy.fft.rfft(y, Nfft, workers=workers)
+    C = Y*np.conj(X)
+    r = scipy.fft.irfft(C, Nfft, workers=workers)[:max_latency + 1]
+    k = int(np.argmax(np.abs(r)))
+
+    # residual (sub-sample) delay from the phase slope of the cross-spectrum
+    w = np.fft.rfftfreq(Nfft, d=1.0/(2*np.pi))
+    phase = np.angle(np.sign(r[k])*C*np.exp(1j*w*k))
+    weight = np.abs(C)
+    return k - np.sum(weight*w*phase)/np.sum(weight*w**2)
+
+
+def set_latency(fs, latency, device=None):
+    ''' stores the latency of the device at the sample rate fs '''
+    _LATENCIES[(device, float(fs))] = float(latency)
+
+
+def get_latency(fs, device=None, default=0.0, filename=None):
+    ''' latency of the device at the sample rate fs, measured or loaded in
+        this session, or saved in filename if given (default if unknown);
+        the latency of another device is never used '''
+    latencies = {**_read_latencies(filename), **_LATENCIES}
+    return latencies.get((device, float(fs)), default)
+
+
+def measure_latency(x, y, fs, device=None, filename=LATENCY_FILE, **kwargs):
+    ''' estimates the latency (see estimate_latency), caches it for the
+        device at the sample rate fs and saves it in filename (if not None) '''
+    latency = estimate_latency(x, y, **kwargs)
+    set_latency(fs, latency, device)
+    if filename is not None:
+        save_latencies(filename)
+    return latency
+
+
+def save_latencies(filename=LATENCY_FILE):
+    ''' adds the latencies of this session to a JSON file '''
+    latencies = {**_read_latencies(filename), **_LATENCIES}
+    data = [{'device': device, 'fs': fs, 'latency': latency}
+            for (device, fs), latency in latencies.items()]
+    # the file is replaced at once (it stays valid if the writing stops)
+    with open(filename + '.tmp', 'w') as file:
+        json.dump(data, file, indent=2)
+    os.replace(filename + '.tmp', filename)
+
+
+def load_latencies(filename=LATENCY_FILE):
+    ''' loads the latencies saved by save_latencies into this session '''
+    _LATENCIES.update(_read_latencies(filename))
+
+
+def _read_latencies(filename):
+    ''' latencies saved in filename ({} if there is no file) '''
+    if filename is None or not os.path.isfile(filename):
+        return {}
+    with open(filename) as file:
+        data = json.load(file)
+
+    latencies = {}
+    for item in data:
+        # JSON has no tuples, e.g. sounddevice (input, output) devices
+        device = item['device']
+        if isinstance(device, list):
+            device = tuple(device)
+        latencies[(device, float(item['fs']))] = float(item['latency'])
+    return latencies
@@ -1,16 +1,25 @@
 # -*- coding: utf-8 -*-
-# Version: 2.0.0
+# Version: 2.3.0
+import threading
+import numpy as np
 import nidaqmx
-from nidaqmx.constants import AcquisitionType, TaskMode, TerminalConfiguration
+from nidaqmx.constants import (AcquisitionType, RegenerationMode, TaskMode,
+                               TerminalConfiguration)
+from nidaqmx.stream_readers import AnalogMultiChannelReader
 
+# number of samples per channel read at once when converting to float32
+READ_BLOCK_SIZE = 2**16
 
-def measurement_NI(x, fs, Dev, iepe=[False, False, False, False]):
+
+def measurement_NI(x, fs, Dev, iepe=[False, False, False, False], dtype=np.float64):
     '''
     Measures data using National Instruments (NI) USB-4431.
 
     This function establishes communication with an NI device specified by `Dev`.
     It configures the analog input channels based on the provided `iepe` parameter.
     Note: Sensitivities are not included; they must be considered separately.
+    The samples are read by the nidaqmx stream reader directly into a
+    preallocated NumPy array (no Python lists of floats).
 
     Args:
     - x (list or ndarray): Input signal.
@@ -18,9 +27,14 @@ def measurement_NI(x, fs, Dev, iepe=[False, False, False, False]):
     - Dev (str): Name of the NI device (e.g., 'Dev1').
     - iepe (list of bool, optional): List indicating whether each channel uses IEPE. 
                                      Defaults to [False, False, False, False].
+    - dtype (numpy dtype, optional): np.float64 (default) or np.float32 to halve
+                                     the memory of long recordings.
 
     Returns:
-    - ndarray: A 2D array containing 4 channels of len(x) samples.
+    - ndarray: A 2D array (channels x len(x) samples), one channel per `iepe` entry.
+
+    For repeated measurements, use a MeasurementSession (the tasks are then
+    configured only once).
 
     Example:
         y = measurement_NI(x, fs, 'Dev1', iepe=[True, False, True, False])
@@ -28,19 +42,136 @@ def measurement_NI(x, fs, Dev, iepe=[False, False, False, False]):
     Author:
         Antonin Novak - 29.10.2021, last update - 10.10.2023
     '''
+    # a session used for one measurement only
+    with MeasurementSession(fs, Dev, iepe=iepe, dtype=dtype) as session:
+        return session.measure(x)
+
+
+def measurement_NI_stream(blocks, fs, Dev, filename, iepe=[False, False, False, False],
+                          block_size=None, dtype=np.float32, tail=None):
+    '''
+    Streaming measurement to disk using National Instruments (NI) USB-4431.
+
+    Same as `measurement_NI`, but for tests of any duration (endurance, power
+    handling): the output signal is taken from a generator of blocks and the
+    recorded blocks are appended to a binary file as they arrive, the memory
+    use does not depend on the duration of the test.
+
+    Args:
+    - blocks (iterable of ndarray): Output signal, block by block (any block length,
+                                    e.g. `sss.signal_blocks()`).
+    - fs (float): Sample rate in Hz.
+    - Dev (str): Name of the NI device (e.g., 'Dev1').
+    - filename (str): Binary file the samples are appended to.
+    - iepe (list of bool, optional): List indicating whether each channel uses IEPE.
+    - block_size (int, optional): Samples per channel written at once (fs by default).
+    - dtype (numpy dtype, optional): Type of the stored samples (np.float32 by default).
+    - tail (int, optional): Samples of silence recorded after the end of the
+                            generator, so that the response delayed by the
+                            latency is not cut (fs/2 by default, rounded up
+                            to whole blocks).
+
+    Returns:
+    - int: Number of samples per channel recorded in the file.
+
+    Example:
+        n = measurement_NI_stream(sss.signal_blocks(), fs, 'Dev1', 'endurance.bin')
+        y = read_stream('endurance.bin', n_channels=4) # (channels x samples) memmap
+    '''
+    with MeasurementSession(fs, Dev, iepe=iepe) as session:
+        return session.stream(blocks, filename, block_size=block_size, dtype=dtype,
+                              tail=tail)
+
+
+def read_stream(filename, n_channels, dtype=np.float32):
+    ''' (channels x samples) memory-mapped view of a file written by
+        `measurement_NI_stream` (samples x channels, appended block by block) '''
+    return np.memmap(filename, dtype=dtype, mode='r').reshape(-1, n_channels).T
+
+
+class MeasurementSession:
+    """
+    Persistent measurement session with a National Instruments (NI) device
+
+    The AO and AI tasks are created, configured (channels, IEPE, timing) and
+    committed only once. Each measurement then only rewrites the output
+    buffer, starts both tasks, reads the inputs and stops the tasks again, so
+    that many play/record cycles can be run back to back (e.g. a loop over
+    amplitudes) without paying the task setup every time.
+
+
+    Usage
+    ----------
+    with MeasurementSession(fs, 'Dev1', iepe=[False, False, False, False]) as session:
+        for A in amplitudes:
+            y = session.measure(A*x) # (channels x len(x)) numpy array
+
+    # or without the with statement
+    session = MeasurementSession(fs, 'Dev1')
+    y = session.measure(x)
+    session.close()
+
+
+    Attributes
+    ----------
+    fs : float
+        sample rate
+    Dev : str
+        name of the NI device (e.g. 'Dev1')
+    iepe : list of bool
+        one entry per analog input, True for IEPE channels
+    dtype : numpy dtype
+        np.float64 (default) or np.float32 returned samples
+
+    Methods
+    -------
+    measure(x)
+        plays x on AO0 and records len(x) samples of every input
+    stream(blocks, filename, block_size=None, dtype=np.float32, tail=None)
+        plays a generator of blocks and appends the recorded inputs to a file
+    close()
+        releases the NI tasks
 
-    # Initialize master and slave tasks
-    with nidaqmx.Task() as master_task, nidaqmx.Task() as slave_task:
+    """
+
+    def __init__(self, fs, Dev, iepe=[False, False, False, False], dtype=np.float64):
+        self.fs = fs
+        self.Dev = Dev
+        self.iepe = list(iepe)
+        self.dtype = dtype
+
+        # Initialize master and slave tasks
+        self._master_task = nidaqmx.Task()
+        self._slave_task = nidaqmx.Task()
+        self._n_buffer = None
+
+        try:
+            self._configure()
+        except Exception:
+            self.close()
+            raise
+
+        self._reader = AnalogMultiChannelReader(self._slave_task.in_stream)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _configure(self):
+        ''' channels and timing of both tasks (done once) '''
+        master_task, slave_task = self._master_task, self._slave_task
 
         # Configure the master task's analog output channel
         master_task.ao_channels.add_ao_voltage_chan(
-            Dev + "/ao0", min_val=-3.5, max_val=3.5)
+            self.Dev + "/ao0", min_val=-3.5, max_val=3.5)
 
         # Iterate through each channel and configure based on the `iepe` parameter
-        for index, is_iepe in enumerate(iepe):
+        for index, is_iepe in enumerate(self.iepe):
 
             # Formulate the channel name based on the device and index
-            channel_name = f"{Dev}/ai{index}"
+            channel_name = f"{self.Dev}/ai{index}"
 
             # Configure channel for IEPE (if `is_iepe` is True) or as regular voltage input
             if is_iepe:
@@ -54,18 +185,28 @@ def measurement_NI(x, fs, Dev, iepe=[False, False, False, False]):
 
         # analog input port is configured for continuous 8000 s/s )
         master_task.timing.cfg_samp_clk_timing(
-            fs, sample_mode=AcquisitionType.CONTINUOUS)
+            self.fs, sample_mode=AcquisitionType.CONTINUOUS)
         # analog output port is configured for continous 8000 s/S
         slave_task.timing.cfg_samp_clk_timing(
-            fs, sample_mode=AcquisitionType.CONTINUOUS)
+            self.fs, sample_mode=AcquisitionType.CONTINUOUS)
+
+    def measure(self, x):
+        ''' plays the signal x and returns the recorded inputs
+            as a (channels x len(x)) numpy array '''
+        master_task, slave_task = self._master_task, self._slave_task
+        x = np.ascontiguousarray(x, dtype=np.float64)
+        n_samples = len(x)
 
         """ Start generating AO and reading AI"""
 
-        master_task.write(x)  # analog output buffer is filled with sine wave
-        # analog output port is committed
-        master_task.control(TaskMode.TASK_COMMIT)
+        # the output buffer is only resized when the signal length changes
+        if n_samples != self._n_buffer:
+            master_task.out_stream.output_buf_size = n_samples
+            self._n_buffer = n_samples
 
-        # analog input port is committed
+        master_task.write(x)  # analog output buffer is filled with the signal
+        # analog ports are committed (nothing to do after the first measurement)
+        master_task.control(TaskMode.TASK_COMMIT)
         slave_task.control(TaskMode.TASK_COMMIT)
 
         print('Acqusition is started')
@@ -74,17 +215,146 @@ def measurement_NI(x, fs, Dev, iepe=[False, False, False, False]):
 
         """ Done """
 
-        result = slave_task.read(
-            number_of_samples_per_channel=len(x), timeout=-1)  # analog input
+        try:
+            result = self._read(n_samples)
+        finally:
+            # stopped tasks go back to the committed state, ready for the next run
+            master_task.stop()
+            slave_task.stop()
 
         print('Acqusition is finished')
         return result
 
+    def _read(self, n_samples):
+        ''' analog input is read into a preallocated (channels x samples) array '''
+        n_channels = len(self.iepe)
+        result = np.empty((n_channels, n_samples), dtype=self.dtype)
+
+        if result.dtype == np.float64:
+            self._reader.read_many_sample(
+                result, number_of_samples_per_channel=n_samples, timeout=-1)
+        else:
+            # the reader needs float64, read by blocks and convert
+            buffer = np.empty(n_channels*min(READ_BLOCK_SIZE, n_samples))
+            for start in range(0, n_samples, READ_BLOCK_SIZE):
+                n = min(READ_BLOCK_SIZE, n_samples - start)
+                block = buffer[:n_channels*n].reshape(n_channels, n)
+                self._reader.read_many_sample(
+                    block, number_of_samples_per_channel=n, timeout=-1)
+                result[:, start:start + n] = block
+
+        return result
+
+    def stream(self, blocks, filename, block_size=None, dtype=np.float32, tail=None):
+        ''' plays the blocks of a generator and appends the recorded inputs to
+            the binary file filename (samples x channels), followed by tail
+            samples of silence (fs/2 by default, rounded up to whole blocks),
+            returns the number of samples per channel recorded '''
+        master_task, slave_task = self._master_task, self._slave_task
+        block_size = int(self.fs) if block_size is None else int(block_size)
+        tail = int(self.fs)//2 if tail is None else int(tail)
+        n_tail = -(-tail//block_size)  # blocks recorded after the end of the signal
+        n_channels = len(self.iepe)
+        blocks = _fixed_blocks(blocks, block_size)
+
+        # no regeneration: the AO buffer (4 blocks) is refilled while playing
+        master_task.out_stream.regen_mode = RegenerationMode.DONT_ALLOW_REGENERATION
+        master_task.out_stream.output_buf_size = 4*block_size
+        self._n_buffer = None
+
+        buffer = np.empty((n_channels, block_size))
+        zeros = np.zeros(block_size)
+        done = threading.Event()
+        errors = []
+        n_played = 0
+        n_recorded = 0
+
+        def next_block():
+            # zeros are played after the end of the signal (until the AI stops)
+            nonlocal n_played
+            x = next(blocks, None)
+            if x is None:
+                return zeros
+            n_played += 1
+            return x
+
+        with open(filename, 'ab') as file:
+
+            def callback(task_handle, every_n_samples_event_type,
+                         number_of_samples, callback_data):
+                # called by NI-DAQmx each time a block of samples was acquired
+                nonlocal n_recorded
+                try:
+                    self._reader.read_many_sample(
+                        buffer, number_of_samples_per_channel=block_size, timeout=0)
+                    file.write(buffer.T.astype(dtype).tobytes())
+                    n_recorded += 1
+                    if n_recorded >= n_played + n_tail:
+                        done.set()
+                    else:
+                        master_task.write(next_block())
+                except Exception as e:
+                    errors.append(e)
+                    done.set()
+                return 0
+
+            slave_task.register_every_n_samples_acquired_into_buffer_event(
+                block_size, callback)
+            try:
+                # two blocks are written ahead of the output
+                master_task.write(np.concatenate((next_block(), next_block())))
+                master_task.control(TaskMode.TASK_COMMIT)
+                slave_task.control(TaskMode.TASK_COMMIT)
+
+                if n_played > 0:
+                    print('Acqusition is started')
+                    slave_task.start()
+                    master_task.start()
+                    done.wait()
+                    master_task.stop()
+                    slave_task.stop()
+                    print('Acqusition is finished')
+            finally:
+                # the session is ready for measure() again
+                slave_task.register_every_n_samples_acquired_into_buffer_event(
+                    block_size, None)
+                master_task.out_stream.regen_mode = RegenerationMode.ALLOW_REGENERATION
+
+        if errors:
+            raise errors[0]
+        return n_recorded*block_size
+
+    def close(self):
+        ''' releases the NI tasks '''
+        for task in (self._master_task, self._slave_task):
+            if task is not None:
+                task.close()
+        self._master_task = self._slave_task = None
+
+
+def _fixed_blocks(blocks, block_size):
+    ''' regroups an iterable of blocks of any length into float64 blocks of
+        block_size samples (the last one is padded with zeros) '''
+    pending = np.zeros(block_size)
+    n = 0
+    for x in blocks:
+        x = np.asarray(x, dtype=np.float64)
+        while len(x) > 0:
+            k = min(block_size - n, len(x))
+            pending[n:n + k] = x[:k]
+            n += k
+            x = x[k:]
+            if n == block_size:
+                yield pending.copy()
+                n = 0
+    if n > 0:
+        pending[n:] = 0
+        yield pending
+
 
 if __name__ == "__main__":
 
     import matplotlib.pyplot as plt
-    import numpy as np
 
     """ Creating Sine wave for Analog output generation"""
 